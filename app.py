@@ -1,5 +1,5 @@
 
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+from flask import Flask, render_template, stream_template, request, redirect, url_for, session, flash
 from dotenv import load_dotenv
 import os
 from get_spotify_api_key import *
@@ -11,6 +11,11 @@ from match_the_mood import *
 from decorators import *
 from playlist_feature import *
 from save_songs import *
+from genre_cache import *
+from migrations import migrate
+from session_store import create_session_interface
+from result_cache import store_result, load_result
+from precomputed_store import load_precomputed_store
 
 # Load environment variables from .env file
 load_dotenv()
@@ -18,6 +23,17 @@ load_dotenv()
 # Initialize Flask application
 app = Flask(__name__)
 app.secret_key = os.getenv('FLASK_SECRET_KEY')
+# Keep session data on the server, the browser only gets an opaque session id
+app.session_interface = create_session_interface()
+
+# Create or upgrade the database tables before serving any requests
+migrate()
+
+# Start every worker with the saved genre list so the *_info pages don't wait on Spotify
+warm_genre_cache()
+
+# Map the nightly precomputed pools so popular requests never wait on GPT or Spotify
+load_precomputed_store()
 
 
 @app.route('/')
@@ -40,6 +56,8 @@ def login():
         password = request.form['password']
         user = login_user(username, password)
         if user:
+            # New id on login so a session id planted before it can't ride along
+            session.regenerate()
             session['user_id'] = user['user_id']
             return redirect(url_for('get_spotify_info'))
         else:
@@ -99,6 +117,8 @@ def callback():
         session['refresh_token'] = token_info['refresh_token']
         session['expires_at'] = datetime.now().timestamp() + \
             token_info['expires_in']
+        # Fetch the Spotify profile once here instead of on every playlist action
+        load_spotify_profile()
 
         return redirect(url_for('dashboard'))
 
@@ -154,13 +174,13 @@ def match_the_day_info():
             flash("Failed to get song recommendations. Please try again.", "error")
             return redirect(url_for('match_the_day_info'))
 
-        return render_template('song_matches.html', songs=songs, city=city, activity=activity, weather_stats=weather_stats)
+        return render_song_matches(songs, city=city, activity=activity, weather_stats=weather_stats)
 
     # Reset if navigating back
     session.pop('city', None)
     session.pop('activity', None)
     session.pop('genre', None)
-    genres = get_spotify_genres()
+    genres = get_genres()
     return render_template('match_the_day_info.html', genres=genres)
 
 
@@ -189,12 +209,12 @@ def match_the_mood_info():
             flash("Failed to get song recommendations. Please try again.", "error")
             return redirect(url_for('match_the_mood_info'))
 
-        return render_template('song_matches.html', songs=songs, mood=mood)
+        return render_song_matches(songs, mood=mood)
 
     # Reset if navigating back
     session.pop('mood', None)
     session.pop('genre', None)
-    genres = get_spotify_genres()
+    genres = get_genres()
     return render_template('match_the_mood_info.html', genres=genres)
 
 
@@ -218,11 +238,11 @@ def match_the_song_info():
             flash("Failed to get similar songs. Please try again.", "error")
             return redirect(url_for('match_the_song_info'))
 
-        return render_template('song_matches.html', songs=songs, original_song=original_song)
+        return render_song_matches(songs, original_song=original_song)
 
     # Reset if navigating back
     session.pop('original_song', None)
-    genres = get_spotify_genres()
+    genres = get_genres()
     return render_template('match_the_song_info.html', genres=genres)
 
 
@@ -233,7 +253,7 @@ def song_matches():
     """
     Render song matches and handle song saving.
 
-    GET: Redirect to the appropriate match feature.
+    GET: Render the last song matches from the result cache.
     POST: Save the selected song to the database.
     """
     if request.method == 'POST':
@@ -251,23 +271,37 @@ def song_matches():
         else:
             return {"status": "error", "message": "Song failed to save. Please try again"}, 500
 
-    # The following code just grab's the page we came from so that we can redirect the user to it
-    previous_page = session.get('previous_page')
-    if previous_page == 'match_the_day_info':
-        city = session.get('city')
-        activity = session.get('activity')
-        weather_stats = session.get('weather_stats')
-        songs = get_songs_from_activity(city, activity, genre)
-        return render_template('song_matches.html', songs=songs, city=city, activity=activity, weather_stats=weather_stats)
-    elif previous_page == 'match_the_mood_info':
-        mood = session.get('mood')
-        genre = session.get('genre')
-        songs = get_songs_from_mood(mood, genre)
-        return render_template('song_matches.html', songs=songs, mood=mood)
-    elif previous_page == 'match_the_song_info':
-        original_song = session.get('original_song')
-        songs = get_similar_songs(original_song)
-        return render_template('song_matches.html', songs=songs, original_song=original_song)
+    # Show the last result again straight from the result cache instead of rerunning the pipeline
+    return render_stored_result(session.get('result_id'))
+
+
+@app.route('/song_matches/<result_id>')
+@login_required
+def song_matches_result(result_id):
+    """
+    Render a stored set of song matches by its id, only for the user it was made for.
+    """
+    return render_stored_result(result_id)
+
+
+def render_song_matches(songs, **context):
+    """
+    Store a recommendation result server-side, remember it in the session and render it.
+    """
+    result_id = store_result(session.get('user_id'), songs, context)
+    session['result_id'] = result_id
+    return render_template('song_matches.html', songs=songs, result_id=result_id, **context)
+
+
+def render_stored_result(result_id):
+    """
+    Render a stored result, or send the user back to the dashboard if it expired or isn't theirs.
+    """
+    songs, context = load_result(session.get('user_id'), result_id)
+    if songs is None:
+        flash("Those song matches have expired. Please try again.", "info")
+        return redirect(url_for('dashboard'))
+    return render_template('song_matches.html', songs=songs, result_id=result_id, **context)
 
 
 # Route for saving a song
@@ -295,6 +329,42 @@ def save_a_song():
             return {"status": "error", "message": "Song failed to save. Please try again"}, 500
 
 
+def is_valid_song(song):
+    """
+    Whether one song from a save_all_songs request has every field save_songs_bulk needs, as strings.
+    """
+    if not isinstance(song, dict):
+        return False
+    if not all(isinstance(song.get(field), str) for field in ('song_name', 'artist_name', 'song_link', 'uri')):
+        return False
+    return isinstance(song.get('album_name'), (str, type(None)))
+
+
+@app.route('/save_all_songs', methods=['POST'])
+@login_required
+def save_all_songs():
+    """
+    Save every song from the song matches page at once.
+
+    POST: JSON with a list of songs, each with the same fields as the single save form. Songs already saved are skipped.
+    """
+    if not request.is_json:
+        return {"status": "error", "message": "Request must be JSON"}, 400
+
+    data = request.get_json(silent=True)
+    songs = data.get('songs', []) if isinstance(data, dict) else None
+    # Checked up front so a bad song can't fail the bulk insert halfway through
+    if not isinstance(songs, list) or not all(is_valid_song(song) for song in songs):
+        return {"status": "error", "message": "Every song needs a song_name, artist_name, song_link and uri"}, 400
+
+    user_id = session.get('user_id')
+    saved = save_songs_bulk(user_id, songs)
+
+    if saved is None:
+        return {"status": "error", "message": "Songs failed to save. Please try again"}, 500
+    return {"status": "success", "message": f"Saved {saved} new songs", "saved": saved}, 200
+
+
 # Route for viewing saved songs
 @app.route('/saved_songs', methods=['POST', 'GET'])
 @login_required
@@ -303,22 +373,33 @@ def saved_songs():
     """
     Render the saved songs page and display the user's saved songs and playlists.
 
-    GET/POST: Check for access token and expiration, retrieve saved songs and playlists, and render the page.
+    GET/POST: Retrieve saved songs and playlists and render the page, spotify_login_required keeps the access token fresh.
     """
     user_id = session.get('user_id')
 
-    if 'access_token' not in session:
-        return redirect(url_for('dashboard'))
-
-    if datetime.now().timestamp() > session['expires_at']:
-        return redirect(url_for('refresh_token'))
-
-    # get saved songs from db
-    saved_songs = get_saved_songs(user_id)
     # get playlists from db, should store playlist name and id
     playlists = get_user_playlists()
 
-    return render_template('saved_songs.html', saved_songs=saved_songs, playlists=playlists)
+    # Saved songs are read from the db a page at a time while the template streams out
+    return stream_template('saved_songs.html', saved_songs=iter_saved_songs(user_id), playlists=playlists)
+
+
+@app.route('/api/saved_songs')
+@login_required
+def saved_songs_api():
+    """
+    Return one page of the user's saved songs as JSON, newest first.
+
+    GET: Pass the next_before value from the previous page as ?before= to get the following page, ?limit= sets the page size.
+    """
+    user_id = session.get('user_id')
+    before_id = request.args.get('before', type=int)
+    limit = request.args.get('limit', SAVED_SONGS_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, SAVED_SONGS_MAX_PAGE_SIZE))
+
+    songs = [dict(song) for song in get_saved_songs_page(user_id, before_id, limit)]
+    next_before = songs[-1]['id'] if len(songs) == limit else None
+    return jsonify({"songs": songs, "next_before": next_before})
 
 
 @app.route('/create_playlist', methods=['POST'])
@@ -366,6 +447,52 @@ def add_to_playlist():
     return redirect(url_for("saved_songs"))
 
 
+@app.route('/add_to_playlist_bulk', methods=['POST'])
+@login_required
+@spotify_login_required
+def add_to_playlist_bulk():
+    """
+    Add many songs to a Spotify playlist in one request.
+
+    POST: JSON with a playlist_id (or a name to create a new playlist) plus saved song_ids and/or uris, returns a result for every batch sent to Spotify.
+    """
+    if not request.is_json:
+        return jsonify({"success": False, "message": "Request must be JSON"}), 400
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"success": False, "message": "Request body must be a JSON object"}), 400
+    song_ids = data.get('song_ids', [])
+    # JSON true/false come through as bool, which is an int subclass
+    if not isinstance(song_ids, list) or not all(isinstance(song_id, int) and not isinstance(song_id, bool) for song_id in song_ids):
+        return jsonify({"success": False, "message": "song_ids must be a list of saved song ids"}), 400
+    extra_uris = data.get('uris', [])
+    # Anything else would be forwarded to Spotify as-is
+    if not isinstance(extra_uris, list) or not all(isinstance(uri, str) and uri.startswith('spotify:track:') for uri in extra_uris):
+        return jsonify({"success": False, "message": "uris must be a list of spotify:track: URIs"}), 400
+
+    user_id = session.get('user_id')
+    uris = get_saved_song_uris(user_id, song_ids) + extra_uris
+    if not uris:
+        return jsonify({"success": False, "message": "No songs to add"}), 400
+
+    playlist_id = data.get('playlist_id')
+    if not playlist_id and data.get('name'):
+        # Lets us save every match to a brand new playlist in one action
+        playlist = create_playlist_helper(data['name'], data.get('description', ''), data.get('public', False))
+        playlist_id = playlist.get('id')
+    if not playlist_id:
+        return jsonify({"success": False, "message": "No playlist to add songs to"}), 400
+
+    results = add_tracks_to_playlist(playlist_id, uris)
+    if results is None:
+        return jsonify({"success": False, "message": "Not logged in to Spotify"}), 401
+
+    success = all(result['success'] for result in results)
+    added = sum(result['count'] for result in results if result['success'])
+    return jsonify({"success": success, "playlist_id": playlist_id, "added": added, "chunks": results}), 200 if success else 500
+
+
 # Route for deleting a saved song
 @app.route('/delete_saved_song/<int:song_id>', methods=['POST'])
 def delete_saved_song(song_id):
@@ -394,6 +521,7 @@ def logout():
 
     Redirect to the home page.
     """
+    session.regenerate()
     session.clear()  # Clear all session variables
     return redirect(url_for('home'))
 
@@ -0,0 +1,73 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+from db import get_db_connection, close_db_connection
+from migrations import migrate, LATEST_VERSION
+
+
+def fill_saved_songs(path, rows, users):
+    """
+    Insert rows fake saved songs spread evenly across users.
+    """
+    conn = get_db_connection(path)
+    conn.executemany('''INSERT INTO saved_songs (song_name, artist_name, album_name, song_link, uri, user_id)
+                        VALUES (?, ?, ?, ?, ?, ?)''',
+                     ((f"song {i}", f"artist {i % 5000}", f"album {i % 20000}",
+                       f"https://open.spotify.com/track/{i}", f"spotify:track:{i}", i % users)
+                      for i in range(rows)))
+    conn.commit()
+
+
+def time_lookups(path, users, lookups):
+    """
+    Average milliseconds to fetch one user's saved songs the way save_songs.get_saved_songs does.
+    """
+    conn = get_db_connection(path)
+    user_ids = [random.randrange(users) for _ in range(lookups)]
+    start = time.perf_counter()
+    for user_id in user_ids:
+        conn.execute('SELECT * FROM saved_songs WHERE user_id=? ORDER BY id',
+                     (user_id,)).fetchall()
+    return (time.perf_counter() - start) * 1000 / lookups
+
+
+def show_plan(path):
+    conn = get_db_connection(path)
+    plan = conn.execute('EXPLAIN QUERY PLAN SELECT * FROM saved_songs WHERE user_id=? ORDER BY id',
+                        (1,)).fetchall()
+    for row in plan:
+        print(f"    {row[-1]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark saved songs lookups before and after the saved_songs indexes.")
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--lookups', type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        migrate(path, target_version=1)
+
+        start = time.perf_counter()
+        fill_saved_songs(path, args.rows, args.users)
+        print(f"Inserted {args.rows} rows for {args.users} users in {time.perf_counter() - start:.1f}s")
+
+        print("Without indexes (schema version 1):")
+        show_plan(path)
+        print(f"    {time_lookups(path, args.users, args.lookups):.3f} ms per lookup")
+
+        migrate(path, target_version=LATEST_VERSION)
+        print(f"With indexes (schema version {LATEST_VERSION}):")
+        show_plan(path)
+        print(f"    {time_lookups(path, args.users, args.lookups):.3f} ms per lookup")
+
+        close_db_connection(path)
+
+
+if __name__ == "__main__":
+    main()
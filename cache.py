@@ -0,0 +1,220 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+from db import get_db_connection
+
+# Load environment variables from .env file
+load_dotenv()
+
+# SQLite file shared by every persistent cache, kept apart from users.db
+CACHE_DB_PATH = os.getenv('CACHE_DB_PATH', 'cache.db')
+# How long expired entries are kept around to fall back on when an upstream is failing or out of budget
+STALE_CACHE_TTL = int(os.getenv('STALE_CACHE_TTL', 24 * 60 * 60))
+
+
+def normalize_text(text):
+    """
+    Lowercase and collapse whitespace so small differences in user input share a cache entry.
+    """
+    return ' '.join(str(text).lower().split())
+
+
+def get_hit_rate(stats):
+    """
+    Fraction of lookups that were hits, None before the first lookup.
+    """
+    lookups = stats['hits'] + stats['misses']
+    return stats['hits'] / lookups if lookups else None
+
+
+class TTLCache:
+    """
+    Thread-safe in-memory LRU cache whose entries expire after ttl seconds.
+    Expired entries are kept for stale_ttl more seconds, only get_stale hands them out.
+    """
+
+    def __init__(self, capacity=1024, ttl=600, stale_ttl=0):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.stats = {'hits': 0, 'misses': 0, 'expired': 0,
+                      'evictions': 0, 'stale_hits': 0}
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        """
+        Return the cached value for key, or default if it is missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return default
+            expires_at, value = entry
+            now = time.time()
+            if expires_at < now:
+                if expires_at + self.stale_ttl < now:
+                    del self._entries[key]
+                    self.stats['expired'] += 1
+                self.stats['misses'] += 1
+                return default
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return value
+
+    def get_stale(self, key, default=None):
+        """
+        Return the value for key even if it has expired, as long as it is within stale_ttl. For degrading gracefully.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] + self.stale_ttl < time.time():
+                return default
+            self.stats['stale_hits'] += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        """
+        Store value under key, evicting the least recently used entries once over capacity.
+        """
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def pop(self, key, default=None):
+        """
+        Remove key and return its value, or default if it wasn't cached.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        """
+        Remove every entry.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_stats(self):
+        """
+        Hit, miss and eviction counters along with the current number of entries.
+        """
+        return dict(self.stats, size=len(self._entries), capacity=self.capacity,
+                    hit_rate=get_hit_rate(self.stats))
+
+
+class PersistentCache:
+    """
+    LRU + TTL cache stored in SQLite so entries survive restarts, values must be JSON serializable.
+    """
+
+    def __init__(self, namespace, capacity=10000, ttl=7 * 24 * 60 * 60, db_path=None):
+        self.namespace = namespace
+        self.capacity = capacity
+        self.ttl = ttl
+        self.db_path = db_path or CACHE_DB_PATH
+        # Hits only write last_used back once it is this stale, eviction order doesn't need to be exact
+        self.touch_interval = ttl / 10
+        self.stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0}
+        self._lock = threading.Lock()
+        self._table_created = False
+
+    def _get_connection(self):
+        """
+        This thread's connection to the cache database, creating the table on first use.
+        """
+        conn = get_db_connection(self.db_path)
+        if not self._table_created:
+            conn.execute('''CREATE TABLE IF NOT EXISTS cache_entries (
+                                namespace TEXT NOT NULL,
+                                key TEXT NOT NULL,
+                                value TEXT NOT NULL,
+                                expires_at REAL NOT NULL,
+                                last_used REAL NOT NULL,
+                                PRIMARY KEY (namespace, key)
+                            )''')
+            conn.execute('''CREATE INDEX IF NOT EXISTS idx_cache_entries_lru
+                              ON cache_entries (namespace, last_used)''')
+            conn.commit()
+            self._table_created = True
+        return conn
+
+    def get(self, key):
+        """
+        Return the cached value for key, or None if it is missing or expired.
+        """
+        now = time.time()
+        conn = self._get_connection()
+        row = conn.execute('SELECT value, expires_at, last_used FROM cache_entries WHERE namespace=? AND key=?',
+                           (self.namespace, key)).fetchone()
+        if row is None:
+            with self._lock:
+                self.stats['misses'] += 1
+            return None
+        if row['expires_at'] < now:
+            conn.execute('DELETE FROM cache_entries WHERE namespace=? AND key=?',
+                         (self.namespace, key))
+            conn.commit()
+            with self._lock:
+                self.stats['expired'] += 1
+                self.stats['misses'] += 1
+            return None
+        if now - row['last_used'] >= self.touch_interval:
+            conn.execute('UPDATE cache_entries SET last_used=? WHERE namespace=? AND key=?',
+                         (now, self.namespace, key))
+            conn.commit()
+        with self._lock:
+            self.stats['hits'] += 1
+        return json.loads(row['value'])
+
+    def set(self, key, value):
+        """
+        Store value under key, evicting the least recently used entries once over capacity.
+        """
+        now = time.time()
+        conn = self._get_connection()
+        conn.execute('''INSERT OR REPLACE INTO cache_entries (namespace, key, value, expires_at, last_used)
+                        VALUES (?, ?, ?, ?, ?)''',
+                     (self.namespace, key, json.dumps(value), now + self.ttl, now))
+        size = conn.execute('SELECT COUNT(*) FROM cache_entries WHERE namespace=?',
+                            (self.namespace,)).fetchone()[0]
+        evicted = 0
+        if size > self.capacity:
+            evicted = conn.execute('''DELETE FROM cache_entries WHERE namespace=? AND key IN (
+                                        SELECT key FROM cache_entries WHERE namespace=?
+                                        ORDER BY last_used LIMIT ?)''',
+                                   (self.namespace, self.namespace, size - self.capacity)).rowcount
+        conn.commit()
+        if evicted:
+            with self._lock:
+                self.stats['evictions'] += evicted
+
+    def clear(self):
+        """
+        Remove every entry in this cache's namespace.
+        """
+        conn = self._get_connection()
+        conn.execute('DELETE FROM cache_entries WHERE namespace=?',
+                     (self.namespace,))
+        conn.commit()
+
+    def get_stats(self):
+        """
+        Hit, miss and eviction counters along with the current number of entries.
+        """
+        size = self._get_connection().execute('SELECT COUNT(*) FROM cache_entries WHERE namespace=?',
+                                              (self.namespace,)).fetchone()[0]
+        return dict(self.stats, size=size, capacity=self.capacity,
+                    hit_rate=get_hit_rate(self.stats))
@@ -0,0 +1,57 @@
+import os
+import sqlite3
+import threading
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Database location and SQLite tuning, all overridable from the environment
+DATABASE_PATH = os.getenv('DATABASE_PATH', 'users.db')
+DB_CACHE_SIZE_KB = int(os.getenv('DB_CACHE_SIZE_KB', 8192))
+DB_MMAP_SIZE = int(os.getenv('DB_MMAP_SIZE', 64 * 1024 * 1024))
+DB_BUSY_TIMEOUT_MS = int(os.getenv('DB_BUSY_TIMEOUT_MS', 5000))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', 256))
+
+# Each thread keeps its own open connections, keyed by database path
+_local = threading.local()
+
+
+def connect(path):
+    """
+    Open a new SQLite connection in WAL mode with our pragmas applied.
+    """
+    conn = sqlite3.connect(path, cached_statements=DB_STATEMENT_CACHE_SIZE)
+    conn.row_factory = sqlite3.Row  # Allows fetching rows as dictionaries
+    # WAL lets readers keep going while a save is being written
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA cache_size=-{DB_CACHE_SIZE_KB}')
+    conn.execute(f'PRAGMA mmap_size={DB_MMAP_SIZE}')
+    conn.execute(f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}')
+    return conn
+
+
+def get_db_connection(path=None):
+    """
+    Get this thread's connection to the database, opening it on first use. Don't close it, it gets reused.
+    """
+    path = path or DATABASE_PATH
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+
+    conn = connections.get(path)
+    if conn is None:
+        conn = connections[path] = connect(path)
+    return conn
+
+
+def close_db_connection(path=None):
+    """
+    Close this thread's connection to the database, the next call to get_db_connection reopens it.
+    """
+    path = path or DATABASE_PATH
+    conn = getattr(_local, 'connections', {}).pop(path, None)
+    if conn is not None:
+        conn.close()
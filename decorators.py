@@ -1,6 +1,6 @@
 from functools import wraps
 from flask import session, redirect, url_for, flash
-from datetime import datetime
+from playlist_feature import ensure_fresh_token
 
 
 def login_required(f):
@@ -21,8 +21,9 @@ def spotify_login_required(f):
     def decorated_function(*args, **kwargs):
         """
         Spotify login required decorator, ensures users are logged in when accessing certain pages.
+        Tokens close to expiring are refreshed here, users are only sent through Spotify's login if that isn't possible.
         """
-        if 'access_token' not in session or datetime.now().timestamp() > session.get('expires_at', 0):
+        if not ensure_fresh_token():
             return redirect(url_for('get_spotify_info'))
         return f(*args, **kwargs)
     return decorated_function
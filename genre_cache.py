@@ -0,0 +1,147 @@
+import json
+import os
+import threading
+import time
+from dotenv import load_dotenv
+from songs import get_spotify_genres
+from rate_limiter import background_priority
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Genre seeds barely change, so keep them for a day and serve the old list while refreshing
+GENRE_CACHE_TTL = int(os.getenv('GENRE_CACHE_TTL', 24 * 60 * 60))
+GENRE_SNAPSHOT_PATH = os.getenv('GENRE_SNAPSHOT_PATH', 'genre_snapshot.json')
+
+_genre_lock = threading.Lock()
+_refresh_lock = threading.Lock()
+_genres = None
+_fetched_at = 0
+
+genre_cache_stats = {
+    'hits': 0,
+    'stale_hits': 0,
+    'misses': 0,
+    'refreshes': 0,
+    'refresh_errors': 0,
+}
+
+
+def load_genre_snapshot():
+    """
+    Load the genre list saved by a previous worker, returns (None, 0) if there isn't a usable one.
+    """
+    try:
+        with open(GENRE_SNAPSHOT_PATH) as f:
+            snapshot = json.load(f)
+        return snapshot['genres'], snapshot['fetched_at']
+    except (OSError, ValueError, KeyError):
+        return None, 0
+
+
+def save_genre_snapshot(genres, fetched_at):
+    """
+    Write the genre list to disk so a cold worker can start with it, replaces the file atomically.
+    """
+    tmp_path = GENRE_SNAPSHOT_PATH + '.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump({'genres': genres, 'fetched_at': fetched_at}, f)
+        os.replace(tmp_path, GENRE_SNAPSHOT_PATH)
+    except OSError as e:
+        print(f"Error saving genre snapshot: {e}")
+
+
+def refresh_genres(blocking=True):
+    """
+    Fetch the genre seeds from Spotify and store them in memory and on disk, only one refresh runs at a time.
+    """
+    global _genres, _fetched_at
+
+    if not _refresh_lock.acquire(blocking=blocking):
+        return None
+    try:
+        # Another request may have filled the cache while we waited for the lock
+        if blocking and _genres is not None and time.time() - _fetched_at <= GENRE_CACHE_TTL:
+            return _genres
+        try:
+            genres = get_spotify_genres()
+        except Exception as e:
+            print(f"Error refreshing genres: {e}")
+            genre_cache_stats['refresh_errors'] += 1
+            return None
+
+        fetched_at = time.time()
+        with _genre_lock:
+            _genres = genres
+            _fetched_at = fetched_at
+            genre_cache_stats['refreshes'] += 1
+        save_genre_snapshot(genres, fetched_at)
+        return genres
+    finally:
+        _refresh_lock.release()
+
+
+def refresh_genres_in_background():
+    """
+    Start a background refresh unless one is already running.
+    """
+    if not _refresh_lock.locked():
+        threading.Thread(target=background_refresh_genres,
+                         daemon=True).start()
+
+
+def background_refresh_genres():
+    """
+    Thread target for refresh_genres_in_background, the Spotify call counts as background work.
+    """
+    with background_priority():
+        refresh_genres(blocking=False)
+
+
+def load_genres():
+    """
+    Fill the in-memory genre list from the on-disk snapshot if we don't have one yet.
+    """
+    global _genres, _fetched_at
+
+    with _genre_lock:
+        if _genres is None:
+            _genres, _fetched_at = load_genre_snapshot()
+
+
+def warm_genre_cache():
+    """
+    Load the on-disk snapshot at startup and refresh it in the background if it's missing or stale.
+    """
+    load_genres()
+    if _genres is None or time.time() - _fetched_at > GENRE_CACHE_TTL:
+        refresh_genres_in_background()
+
+
+def get_genres():
+    """
+    Get available Spotify genres from the cache, only blocking on Spotify when nothing has been cached yet.
+    """
+    if _genres is None:
+        load_genres()
+
+    genres = _genres
+    if genres is None:
+        genre_cache_stats['misses'] += 1
+        return refresh_genres() or []
+
+    if time.time() - _fetched_at > GENRE_CACHE_TTL:
+        genre_cache_stats['stale_hits'] += 1
+        refresh_genres_in_background()
+    else:
+        genre_cache_stats['hits'] += 1
+    return genres
+
+
+def get_genre_cache_stats():
+    """
+    Counters for how often the genre list was served from memory.
+    """
+    return dict(genre_cache_stats, cached=_genres is not None,
+                age=time.time() - _fetched_at if _genres is not None else None)
@@ -1,5 +1,7 @@
 import os
-import requests
+import threading
+import time
+import http_client
 from dotenv import load_dotenv
 
 # Load environment variables from a .env file
@@ -9,24 +11,61 @@ load_dotenv()
 SPOTIFY_CLIENT_ID = os.getenv('SPOTIFY_CLIENT_ID')
 SPOTIFY_CLIENT_SECRET = os.getenv('SPOTIFY_CLIENT_SECRET')
 
+# Spotify authorization URL
+SPOTIFY_TOKEN_URL = "https://accounts.spotify.com/api/token"
 
-def get_spotify_api_key():
-    """
-    Use our spotify web developer credentials to obtain an access token to make API requests.
-    """
-    CLIENT_ID = SPOTIFY_CLIENT_ID
-    CLIENT_SECRET = SPOTIFY_CLIENT_SECRET
+# How many seconds before Spotify's expires_in we stop handing out the cached token
+SPOTIFY_TOKEN_EXPIRY_MARGIN = int(
+    os.getenv('SPOTIFY_TOKEN_EXPIRY_MARGIN', 60))
 
-    # Spotify authorization URL
-    AUTH_URL = "https://accounts.spotify.com/api/token"
+# Process-wide app token shared by every module that talks to the Spotify API
+_token_lock = threading.Lock()
+_cached_token = None
+_token_expires_at = 0
 
+
+def request_spotify_api_key():
+    """
+    Use our spotify web developer credentials to obtain a fresh access token and its lifetime in seconds.
+    """
     # Send POST request to Spotify API to obtain access token
-    auth_response = requests.post(AUTH_URL, {
+    auth_response = http_client.post(SPOTIFY_TOKEN_URL, {
         "grant_type": "client_credentials",
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET,
+        "client_id": SPOTIFY_CLIENT_ID,
+        "client_secret": SPOTIFY_CLIENT_SECRET,
     })
 
     # Parse the JSON response to get the access token
     auth_response_data = auth_response.json()
-    return auth_response_data["access_token"]
+    return auth_response_data["access_token"], auth_response_data.get("expires_in", 3600)
+
+
+def get_spotify_api_key():
+    """
+    Get an access token to make API requests, reusing the cached one until shortly before it expires.
+    """
+    global _cached_token, _token_expires_at
+
+    if _cached_token and time.time() < _token_expires_at:
+        return _cached_token
+
+    # Only one thread asks Spotify for a new token, the rest wait and reuse it
+    with _token_lock:
+        if _cached_token and time.time() < _token_expires_at:
+            return _cached_token
+
+        token, expires_in = request_spotify_api_key()
+        _cached_token = token
+        _token_expires_at = time.time() + expires_in - SPOTIFY_TOKEN_EXPIRY_MARGIN
+        return _cached_token
+
+
+def clear_spotify_api_key():
+    """
+    Forget the cached access token so the next call fetches a new one.
+    """
+    global _cached_token, _token_expires_at
+
+    with _token_lock:
+        _cached_token = None
+        _token_expires_at = 0
@@ -0,0 +1,164 @@
+import json
+import os
+import threading
+import requests
+import rate_limiter
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError
+from urllib3.util.retry import Retry
+from dotenv import load_dotenv
+from openai import OpenAI
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Connection pool and retry settings shared by every outbound API call
+HTTP_POOL_CONNECTIONS = int(os.getenv('HTTP_POOL_CONNECTIONS', 10))
+HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', 20))
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', 10))
+HTTP_MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', 3))
+HTTP_BACKOFF_FACTOR = float(os.getenv('HTTP_BACKOFF_FACTOR', 0.5))
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# Longest Retry-After we'll sleep through in-request, longer ones go back to the caller to degrade
+HTTP_MAX_RETRY_AFTER = float(os.getenv('HTTP_MAX_RETRY_AFTER', 5))
+
+# Hosts whose calls are counted against an upstream budget in rate_limiter, the token endpoint is left alone
+UPSTREAM_HOSTS = {
+    'api.spotify.com': 'spotify',
+    'api.weatherapi.com': 'weather',
+}
+
+# One keep-alive session per host, plus one OpenAI client per API key
+_sessions_lock = threading.Lock()
+_sessions = {}
+_openai_clients = {}
+
+
+class ApiRetry(Retry):
+    """
+    Retry policy for our upstream APIs, POSTs are only retried on 429 since Spotify never applied them.
+    """
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method == 'POST' and status_code != 429:
+            return False
+        return super().is_retry(method, status_code, has_retry_after)
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        # Spotify can ask for minutes, give the response back so request() backs off the budget instead
+        if response is not None and (self.get_retry_after(response) or 0) > HTTP_MAX_RETRY_AFTER:
+            raise MaxRetryError(_pool, url, f"Retry-After longer than {HTTP_MAX_RETRY_AFTER}s")
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
+def build_session():
+    """
+    Create a requests session with a pooled adapter that retries 429/5xx responses and honors Retry-After.
+    """
+    retry = ApiRetry(
+        total=HTTP_MAX_RETRIES,
+        read=0,
+        backoff_factor=HTTP_BACKOFF_FACTOR,
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {'POST'},
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS,
+                          pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session(url):
+    """
+    Get the shared session for the host in url, creating it on first use.
+    """
+    parts = urlsplit(url)
+    host = f'{parts.scheme}://{parts.netloc}'
+
+    session = _sessions.get(host)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(host)
+            if session is None:
+                session = build_session()
+                _sessions[host] = session
+    return session
+
+
+def rate_limited_response(url, upstream):
+    """
+    Stand-in 429 response for a call our own budget refused, shaped like Spotify's errors so callers handle it as one.
+    """
+    response = requests.Response()
+    response.status_code = 429
+    response.url = url
+    response.headers['Content-Type'] = 'application/json'
+    response._content = json.dumps({"error": {
+        "status": 429,
+        "message": f"Too many requests to {upstream} right now, please try again in a moment."}}).encode('utf-8')
+    return response
+
+
+def request(method, url, **kwargs):
+    """
+    Send a request through the pooled session for its host, using the default timeout unless one is given.
+    Calls to a rate limited upstream wait for its budget and get a 429 response if it stays exhausted.
+    """
+    kwargs.setdefault('timeout', HTTP_TIMEOUT)
+    upstream = UPSTREAM_HOSTS.get(urlsplit(url).hostname)
+    if upstream and not rate_limiter.acquire(upstream):
+        return rate_limited_response(url, upstream)
+
+    response = get_session(url).request(method, url, **kwargs)
+    if upstream and response.status_code == 429:
+        # Still limited after urllib3's retries, pause every worker's budget for this upstream
+        try:
+            retry_after = float(response.headers.get('Retry-After', 1))
+        except ValueError:
+            retry_after = 1
+        rate_limiter.backoff(upstream, retry_after)
+    return response
+
+
+def get(url, params=None, **kwargs):
+    """
+    Pooled replacement for requests.get.
+    """
+    return request('GET', url, params=params, **kwargs)
+
+
+def post(url, data=None, json=None, **kwargs):
+    """
+    Pooled replacement for requests.post.
+    """
+    return request('POST', url, data=data, json=json, **kwargs)
+
+
+def get_openai_client(api_key):
+    """
+    Reuse one OpenAI client per API key so its connection pool stays warm between requests.
+    """
+    client = _openai_clients.get(api_key)
+    if client is None:
+        with _sessions_lock:
+            client = _openai_clients.get(api_key)
+            if client is None:
+                client = OpenAI(api_key=api_key, timeout=HTTP_TIMEOUT * 3,
+                                max_retries=HTTP_MAX_RETRIES)
+                _openai_clients[api_key] = client
+    return client
+
+
+def create_chat_completion(api_key, **kwargs):
+    """
+    Chat completion through the shared OpenAI client, raises RateLimitExceeded if the OpenAI budget is exhausted.
+    """
+    if not rate_limiter.acquire('openai'):
+        raise rate_limiter.RateLimitExceeded('openai')
+    return get_openai_client(api_key).chat.completions.create(**kwargs)
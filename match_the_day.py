@@ -1,10 +1,18 @@
-import requests
+import http_client
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from dataclasses import dataclass, field
 from dotenv import load_dotenv
 from openai import OpenAI
 # Imports SPOTIFY_CLIENT_ID and SPOTIFY_CLIENT_SECRET
 from get_spotify_api_key import *
 from songs import *  # Import functions from songs.py
+from cache import PersistentCache, TTLCache, normalize_text
+from recommender import recommend_songs, rank_candidates
+from precomputed_store import get_precomputed_pool
+from request_log import log_request, get_request_key
+from single_flight import single_flight
 
 
 # Get API keys from environment variables
@@ -14,13 +22,69 @@ GPT_API_KEY = os.getenv('GPT_API_KEY')
 SPOTIFY_CLIENT_ID = os.getenv('SPOTIFY_CLIENT_ID')
 SPOTIFY_CLIENT_SECRET = os.getenv('SPOTIFY_CLIENT_SECRET')
 
+# Per-stage timeouts in seconds for the match the day pipeline
+WEATHER_STAGE_TIMEOUT = float(os.getenv('WEATHER_STAGE_TIMEOUT', 5))
+GPT_STAGE_TIMEOUT = float(os.getenv('GPT_STAGE_TIMEOUT', 15))
+SPOTIFY_STAGE_TIMEOUT = float(os.getenv('SPOTIFY_STAGE_TIMEOUT', 10))
+PIPELINE_WORKERS = int(os.getenv('PIPELINE_WORKERS', 16))
 
+# GPT answers barely change for the same inputs, so both GPT features share one persistent cache
+GPT_CACHE_CAPACITY = int(os.getenv('GPT_CACHE_CAPACITY', 5000))
+GPT_CACHE_TTL = int(os.getenv('GPT_CACHE_TTL', 7 * 24 * 60 * 60))
+TEMPERATURE_BUCKET = int(os.getenv('TEMPERATURE_BUCKET', 5))
+gpt_query_cache = PersistentCache(
+    'gpt_query_words', capacity=GPT_CACHE_CAPACITY, ttl=GPT_CACHE_TTL)
+
+# Weather is cached under the city WeatherAPI resolved to, with what users typed mapped onto it
+WEATHER_CACHE_TTL = int(os.getenv('WEATHER_CACHE_TTL', 10 * 60))
+WEATHER_CACHE_CAPACITY = int(os.getenv('WEATHER_CACHE_CAPACITY', 1000))
+WEATHER_STALE_TTL = int(os.getenv('WEATHER_STALE_TTL', 60 * 60))
+weather_cache = TTLCache(capacity=WEATHER_CACHE_CAPACITY,
+                         ttl=WEATHER_CACHE_TTL, stale_ttl=WEATHER_STALE_TTL)
+city_aliases = TTLCache(capacity=WEATHER_CACHE_CAPACITY * 4,
+                        ttl=24 * 60 * 60)
+
+# Shared by every request so independent remote calls can overlap
+_pipeline_executor = ThreadPoolExecutor(
+    max_workers=PIPELINE_WORKERS, thread_name_prefix='match-the-day')
+
+
+@dataclass
+class ActivityResult:
+    """
+    Everything the match the day pipeline produced, with how far into the request each stage finished.
+    """
+    songs: dict = None
+    weather_stats: tuple = None
+    city_name: str = None
+    query_words: str = None
+    used_genre_fallback: bool = False
+    used_precomputed: bool = False
+    error: str = None
+    timings: dict = field(default_factory=dict)
+
+
+def get_city_key(city_name, region):
+    """
+    Canonical cache key for a location returned by WeatherAPI.
+    """
+    return normalize_text(f"{city_name}, {region}")
+
+
+@single_flight(lambda city, api_key: normalize_text(city))
 def weather_forecast(city, api_key):
     """
     Given a city entered in by the user, requests weather data such as temperature and a short description.
     """
+    alias = normalize_text(city)
+    city_key = city_aliases.get(alias)
+    if city_key is not None:
+        cached = weather_cache.get(city_key)
+        if cached is not None:
+            return cached
+
     url = f'http://api.weatherapi.com/v1/current.json?key={api_key}&q={city}'
-    response = requests.get(url)
+    response = http_client.get(url)
 
     if response.status_code == 200:
         json_response = response.json()
@@ -28,61 +92,157 @@ def weather_forecast(city, api_key):
         region_from_response = json_response['location']['region']
         fahrenheit = json_response['current']['temp_f']
         weather = json_response['current']['condition']['text']
-        return (fahrenheit, weather), city_from_response
+        result = (fahrenheit, weather), city_from_response
+
+        # Only what the user typed is aliased, a bare name like "Springfield" could be any region's
+        city_key = get_city_key(city_from_response, region_from_response)
+        weather_cache.set(city_key, result)
+        city_aliases.set(alias, city_key)
+        return result
     else:
+        # Weather from the last hour beats no recommendations while WeatherAPI is failing or out of budget
+        if city_key is not None:
+            stale = weather_cache.get_stale(city_key)
+            if stale is not None:
+                return stale
         return None, None
 
 
+def bucket_temperature(fahrenheit):
+    """
+    Round a temperature to the nearest TEMPERATURE_BUCKET degrees so nearby readings share GPT answers.
+    """
+    return int(round(float(fahrenheit) / TEMPERATURE_BUCKET) * TEMPERATURE_BUCKET)
+
+
+def get_activity_params(weather_stats, activity, genre):
+    """
+    Normalized inputs that decide a match the day result, the same temperature bucket and condition GPT is asked about.
+    """
+    return [bucket_temperature(weather_stats[0]), normalize_text(weather_stats[1]),
+            normalize_text(activity), normalize_text(genre)]
+
+
+@single_flight(lambda weather_stats, activity, api_key: (
+    bucket_temperature(weather_stats[0]), normalize_text(weather_stats[1]), normalize_text(activity)))
 def gpt_query_words(weather_stats, activity, api_key):
     """
     Function to generate spotify search method query words using Openai API GPT-3.5 Turbo based on weather, activity, and genre
     """
-    client = OpenAI(api_key=api_key)
-    completion = client.chat.completions.create(
+    temperature = bucket_temperature(weather_stats[0])
+    condition = normalize_text(weather_stats[1])
+    activity = normalize_text(activity)
+
+    cache_key = f"day:{temperature}:{condition}:{activity}"
+    query_words = gpt_query_cache.get(cache_key)
+    if query_words is not None:
+        return query_words
+
+    completion = http_client.create_chat_completion(
+        api_key,
         model="gpt-3.5-turbo",
         messages=[
             {"role": "system", "content": "You are a spotify genius that specializes in finding the right playlist based off some information. Generate a list of 3 - 5 words or short phrases to use in the Spotify API search function to search for a playlist based on the given information."},
             {"role": "user",
-                "content": f"The weather is {weather_stats[0]} degrees and {weather_stats[1]} and the activity is {activity}."}
+                "content": f"The weather is {temperature} degrees and {condition} and the activity is {activity}."}
         ]
     )
-    return completion.choices[0].message.content
+    query_words = completion.choices[0].message.content
+    gpt_query_cache.set(cache_key, query_words)
+    return query_words
+
+
+def get_genre_fallback_playlist(search):
+    """
+    Pick one playlist from a genre-only search and fetch its tracks, used when GPT can't give us query words.
+    """
+    if not search or "error" in search:
+        return None
+    playlists = [playlist for playlist in search['playlists']['items'] if playlist]
+    if not playlists:
+        return None
+    selected_playlist = random.choice(playlists)
+    prefetch_playlists(
+        [playlist for playlist in playlists if playlist is not selected_playlist])
+    playlist_data = get_playlist_tracks(
+        selected_playlist['id'], selected_playlist.get('snapshot_id'))
+    return playlist_data.get('items')
+
+
+def wait_for_stage(result, name, future, timeout, started):
+    """
+    Wait for a pipeline stage, returns None if it failed or ran past its timeout.
+    """
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        print(f"Match the day {name} stage timed out after {timeout}s")
+    except Exception as e:
+        print(f"Match the day {name} stage failed: {e}")
+    finally:
+        result.timings[name] = time.monotonic() - started
+    return None
 
 
-def recommend_songs(query_words, genre):
+def run_activity_pipeline(city, activity, genre):
     """
-    Uses gpt's query words to make a search spotify, randomly selects a playlist and then randomly selects six songs from this playlist.
+    Runs the match the day pipeline, overlapping every remote call that doesn't depend on another one.
     """
-    playlist = get_playlist_from_spotify(query_words, genre)
+    result = ActivityResult()
+    started = time.monotonic()
 
-    songs = get_songs_from_playlist(genre, playlist)
+    # Neither depends on the other, so start both at once
+    token_future = _pipeline_executor.submit(get_spotify_token)
+    weather_future = _pipeline_executor.submit(
+        weather_forecast, city, WEATHER_API_KEY)
 
-    all_songs = list(songs.values())
-    random_6_songs = random.sample(all_songs, k=min(6, len(all_songs)))
+    weather = wait_for_stage(result, 'weather', weather_future,
+                             WEATHER_STAGE_TIMEOUT, started)
+    result.weather_stats, result.city_name = weather or (None, None)
+    if not result.weather_stats or not result.city_name:
+        result.error = "Failed to get the weather"
+        return result
+
+    params = get_activity_params(result.weather_stats, activity, genre)
+    log_request('day', params)
+    # Common weather and activity combinations are precomputed nightly, skip GPT and Spotify for those
+    pool = get_precomputed_pool(get_request_key('day', params))
+    if pool is not None:
+        result.used_precomputed = True
+        result.songs = rank_candidates(pool)
+        result.timings['total'] = time.monotonic() - started
+        return result
+
+    gpt_future = _pipeline_executor.submit(
+        gpt_query_words, result.weather_stats, activity, GPT_API_KEY)
+    result.query_words = wait_for_stage(
+        result, 'gpt', gpt_future, GPT_STAGE_TIMEOUT, started)
+    wait_for_stage(result, 'token', token_future,
+                   SPOTIFY_STAGE_TIMEOUT, started)
+
+    if result.query_words:
+        result.songs = recommend_songs(result.query_words, genre)
+    else:
+        # Without query words we search by genre alone, only now so the usual path doesn't spend Spotify budget on it
+        genre_search_future = _pipeline_executor.submit(
+            search_spotify_playlists, genre)
+        search = wait_for_stage(result, 'genre_search', genre_search_future,
+                                SPOTIFY_STAGE_TIMEOUT, started)
+        result.used_genre_fallback = True
+        result.songs = recommend_songs(
+            '', genre, get_genre_fallback_playlist(search))
 
-    random_6_songs_dict = {}
-    for i, song in enumerate(random_6_songs):
-        random_6_songs_dict[i + 1] = {
-            "song_name": song["song_name"],
-            "artist_name": song["artist_name"],
-            "album_name": song["album_name"],
-            "song_link": song["song_link"],
-            "album_cover": song["album_cover"],
-            "popularity": song["popularity"],
-            "uri": song["uri"]
-        }
-    return random_6_songs_dict
+    result.timings['total'] = time.monotonic() - started
+    return result
 
 
 def get_songs_from_activity(city, activity, genre):
     """
     Holds main functionality for match the day feature.
     """
-    weather_stats, city_name = weather_forecast(city, WEATHER_API_KEY)
-    if not weather_stats or not city_name:
+    result = run_activity_pipeline(city, activity, genre)
+    if result.error:
         return None, None
-    query_words = gpt_query_words(weather_stats, activity, GPT_API_KEY)
-    songs = recommend_songs(query_words, genre)
 
     # get activity from session in app.py, use all this for match_the_mood.html
-    return songs, weather_stats
+    return result.songs, result.weather_stats
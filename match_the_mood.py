@@ -1,11 +1,17 @@
-import requests
+import http_client
 import os
 from dotenv import load_dotenv
 from openai import OpenAI
 # Imports SPOTIFY_CLIENT_ID and SPOTIFY_CLIENT_SECRET
 from get_spotify_api_key import *
 from songs import *
-from match_the_day import recommend_songs
+from match_the_day import gpt_query_cache
+from recommender import recommend_songs, rank_candidates
+from cache import normalize_text
+from precomputed_store import get_precomputed_pool
+from request_log import log_request, get_request_key
+from rate_limiter import RateLimitExceeded
+from single_flight import single_flight
 
 
 # Get API keys from environment variables
@@ -16,12 +22,19 @@ SPOTIFY_CLIENT_SECRET = os.getenv('SPOTIFY_CLIENT_SECRET')
 
 
 # Uses OpenAI API to get some query words based on a user's mood
+@single_flight(lambda mood, api_key: normalize_text(mood))
 def gpt_query_words_mood(mood, api_key):
     """
     Function to generate spotify search method query words using Openai API GPT-3.5 Turbo based on user's mood
     """
-    client = OpenAI(api_key=api_key)
-    completion = client.chat.completions.create(
+    mood = normalize_text(mood)
+    cache_key = f"mood:{mood}"
+    query_words = gpt_query_cache.get(cache_key)
+    if query_words is not None:
+        return query_words
+
+    completion = http_client.create_chat_completion(
+        api_key,
         model="gpt-3.5-turbo",
         messages=[
             {"role": "system", "content": "You are a spotify genius that specializes in finding the right playlist based off some information. Generate a list of 3 - 5 words or short phrases to use in the Spotify API search function to search for a playlist based on the given mood."},
@@ -29,7 +42,16 @@ def gpt_query_words_mood(mood, api_key):
             {"role": "user", "content": f"I am feeling {mood}."}
         ]
     )
-    return completion.choices[0].message.content
+    query_words = completion.choices[0].message.content
+    gpt_query_cache.set(cache_key, query_words)
+    return query_words
+
+
+def get_mood_params(mood, genre):
+    """
+    Normalized inputs that decide a match the mood result, used for the request log and precomputed pools.
+    """
+    return [normalize_text(mood), normalize_text(genre)]
 
 
 # Essentially the main function to utilize all the former functions
@@ -37,6 +59,18 @@ def get_songs_from_mood(mood, genre):
     """
     Main functionality for match the mood feature, calls other necessary functions
     """
-    query_words = gpt_query_words_mood(mood, GPT_API_KEY)
+    params = get_mood_params(mood, genre)
+    log_request('mood', params)
+    # Popular moods are precomputed nightly, those never reach GPT or Spotify
+    pool = get_precomputed_pool(get_request_key('mood', params))
+    if pool is not None:
+        return rank_candidates(pool), mood
+
+    try:
+        query_words = gpt_query_words_mood(mood, GPT_API_KEY)
+    except RateLimitExceeded as e:
+        # Out of OpenAI budget, a genre-only search still gets the user some songs
+        print(f"Match the mood falling back to genre search: {e}")
+        query_words = ''
     songs = recommend_songs(query_words, genre)
     return songs, mood  # return these to be used by match_the_mood.html
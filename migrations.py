@@ -0,0 +1,99 @@
+import sys
+from db import get_db_connection
+
+# Each migration is (version, description, statements). Append new ones, never edit old ones,
+# the database remembers the last version it ran in PRAGMA user_version.
+MIGRATIONS = [
+    (1, "Create users, saved_songs and playlists tables", [
+        '''CREATE TABLE IF NOT EXISTS users (
+               user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+               username TEXT UNIQUE NOT NULL,
+               password TEXT NOT NULL
+           )''',
+        '''CREATE TABLE IF NOT EXISTS saved_songs (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               song_name TEXT NOT NULL,
+               artist_name TEXT NOT NULL,
+               album_name TEXT,
+               song_link TEXT NOT NULL,
+               uri TEXT NOT NULL,
+               user_id INTEGER,
+               FOREIGN KEY (user_id) REFERENCES users(user_id)
+           )''',
+        '''CREATE TABLE IF NOT EXISTS playlists (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               playlist_id TEXT NOT NULL,
+               playlist_name TEXT NOT NULL,
+               user_id INTEGER,
+               FOREIGN KEY (user_id) REFERENCES users(user_id)
+           )''',
+    ]),
+    (2, "Index saved songs and playlists by user and drop duplicates", [
+        # Keep the first copy of every song a user saved more than once
+        '''DELETE FROM saved_songs WHERE id NOT IN (
+               SELECT MIN(id) FROM saved_songs GROUP BY user_id, uri)''',
+        '''CREATE UNIQUE INDEX IF NOT EXISTS idx_saved_songs_user_uri
+               ON saved_songs (user_id, uri)''',
+        # Serves the saved songs page newest first without sorting
+        '''CREATE INDEX IF NOT EXISTS idx_saved_songs_user_id
+               ON saved_songs (user_id, id)''',
+        '''DELETE FROM playlists WHERE id NOT IN (
+               SELECT MIN(id) FROM playlists GROUP BY user_id, playlist_id)''',
+        '''CREATE UNIQUE INDEX IF NOT EXISTS idx_playlists_user_playlist
+               ON playlists (user_id, playlist_id)''',
+    ]),
+    (3, "Count recommendation requests for the precompute job", [
+        # One row per distinct request, params is the JSON list of normalized inputs
+        '''CREATE TABLE IF NOT EXISTS request_log (
+               kind TEXT NOT NULL,
+               params TEXT NOT NULL,
+               hits INTEGER NOT NULL DEFAULT 0,
+               last_seen REAL NOT NULL,
+               PRIMARY KEY (kind, params)
+           )''',
+        '''CREATE INDEX IF NOT EXISTS idx_request_log_hits
+               ON request_log (kind, hits)''',
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(conn):
+    """
+    Version of the last migration applied to this database.
+    """
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(path=None, target_version=None):
+    """
+    Apply every migration newer than the database's version, each in its own transaction. Returns the new version.
+    """
+    conn = get_db_connection(path)
+    target_version = LATEST_VERSION if target_version is None else target_version
+
+    for version, description, statements in MIGRATIONS:
+        if version > target_version:
+            break
+        # Take the write lock first so two workers starting together don't both run a migration
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if get_schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f'PRAGMA user_version={version}')
+            conn.commit()
+            print(f"Applied migration {version}: {description}")
+        except Exception:
+            conn.rollback()
+            raise
+
+    return get_schema_version(conn)
+
+
+# Run with `python migrations.py` to bring the database up to date
+if __name__ == "__main__":
+    migrate(sys.argv[1] if len(sys.argv) > 1 else None)
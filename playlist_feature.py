@@ -1,8 +1,11 @@
-import requests
+import http_client
 import sys
 # Imports SPOTIFY_CLIENT_ID and SPOTIFY_CLIENT_SECRET
 from get_spotify_api_key import *
+from cache import TTLCache
+import threading
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from flask import Flask, redirect, request, session, url_for, jsonify
 from dotenv import load_dotenv
@@ -18,6 +21,25 @@ AUTH_URL = 'https://accounts.spotify.com/authorize'
 # Change based on where you're hosting webiste
 REDIRECT_URI = 'https://musicmatepersonal.pythonanywhere.com/callback'
 TOKEN_URL = 'https://accounts.spotify.com/api/token'
+# Spotify accepts at most 100 URIs per add-to-playlist request
+PLAYLIST_ADD_BATCH_SIZE = 100
+PLAYLIST_ADD_CONCURRENCY = int(os.getenv('PLAYLIST_ADD_CONCURRENCY', 4))
+# me/playlists is paged, fetch the biggest pages Spotify allows and keep the result per user for a short while
+USER_PLAYLISTS_PAGE_SIZE = 50
+USER_PLAYLISTS_CONCURRENCY = int(os.getenv('USER_PLAYLISTS_CONCURRENCY', 4))
+USER_PLAYLISTS_CACHE_TTL = int(os.getenv('USER_PLAYLISTS_CACHE_TTL', 60))
+user_playlists_cache = TTLCache(capacity=1000, ttl=USER_PLAYLISTS_CACHE_TTL)
+# Spotify profiles (from GET /me) per MusicMate user, reloaded after login and token renewal
+SPOTIFY_PROFILE_CACHE_TTL = int(
+    os.getenv('SPOTIFY_PROFILE_CACHE_TTL', 24 * 60 * 60))
+spotify_profile_cache = TTLCache(
+    capacity=1000, ttl=SPOTIFY_PROFILE_CACHE_TTL)
+# User tokens are refreshed in-request once they're this many seconds from expiring
+SPOTIFY_TOKEN_REFRESH_WINDOW = int(
+    os.getenv('SPOTIFY_TOKEN_REFRESH_WINDOW', 5 * 60))
+# Tokens we just refreshed by refresh token, so other requests with the same grant reuse them instead of refreshing again
+recently_refreshed_tokens = TTLCache(capacity=1000, ttl=60)
+_token_refresh_locks = [threading.Lock() for _ in range(64)]
 
 
 def get_spotify_auth_url():
@@ -49,88 +71,180 @@ def get_token_info(auth_code):
         'client_id': SPOTIFY_CLIENT_ID,
         'client_secret': SPOTIFY_CLIENT_SECRET,
     }
-    response = requests.post(TOKEN_URL, data=request_body)
+    response = http_client.post(TOKEN_URL, data=request_body)
     return response.json()
 
 
-def refresh_token():
+def ensure_fresh_token():
     """
-    Refreshes user's access token if it expires.
+    Make sure the session's access token is good for a while, refreshing it in-request if it's about to expire.
+    Concurrent refreshes of the same grant share one request to Spotify. Returns False if there's no usable token.
     """
-    if 'refresh_token' not in session:
-        return redirect(url_for('dashboard'))
-
-    if datetime.now().timestamp() > session['expires_at']:
-        request_body = {
-            'grant_type': 'refresh_token',
-            'refresh_token': session['refresh_token'],
-            'client_id': SPOTIFY_CLIENT_ID,
-            'client_secret': SPOTIFY_CLIENT_SECRET,
-        }
+    if 'access_token' not in session:
+        return False
 
-        response = requests.post(TOKEN_URL, data=request_body)
-        new_token_info = response.json()
+    now = datetime.now().timestamp()
+    if now < session.get('expires_at', 0) - SPOTIFY_TOKEN_REFRESH_WINDOW:
+        return True
+    if 'refresh_token' not in session:
+        return now < session.get('expires_at', 0)
+
+    # Keyed on the grant, not the MusicMate user, whose other sessions may be linked to another Spotify account
+    grant_key = session['refresh_token']
+    refreshed = False
+    with _token_refresh_locks[hash(grant_key) % len(_token_refresh_locks)]:
+        # Another request with this grant may have refreshed while we waited for the lock
+        token_info = recently_refreshed_tokens.get(grant_key)
+        if token_info is None:
+            request_body = {
+                'grant_type': 'refresh_token',
+                'refresh_token': session['refresh_token'],
+                'client_id': SPOTIFY_CLIENT_ID,
+                'client_secret': SPOTIFY_CLIENT_SECRET,
+            }
+            try:
+                response = http_client.post(TOKEN_URL, data=request_body)
+                token_info = response.json()
+            except Exception as e:
+                print(f"Error refreshing Spotify token: {e}")
+                return now < session.get('expires_at', 0)
+            if 'access_token' not in token_info:
+                print(f"Error refreshing Spotify token: {token_info}")
+                return now < session.get('expires_at', 0)
+
+            token_info['expires_at'] = now + token_info['expires_in']
+            recently_refreshed_tokens.set(grant_key, token_info)
+            refreshed = True
+
+    session['access_token'] = token_info['access_token']
+    session['expires_at'] = token_info['expires_at']
+    # Spotify only sometimes hands out a new refresh token
+    if 'refresh_token' in token_info:
+        session['refresh_token'] = token_info['refresh_token']
+    if refreshed:
+        load_spotify_profile()
+    return True
 
-        session['access_token'] = new_token_info['access_token']
-        session['expires_at'] = datetime.now().timestamp() + \
-            new_token_info['expires_in']
 
-        return redirect(url_for('dashboard'))
+def refresh_token():
+    """
+    Refreshes user's access token if it expires.
+    """
+    if not ensure_fresh_token():
+        return redirect(url_for('get_spotify_info'))
+    return redirect(url_for('dashboard'))
 
 
 def get_user_info():
     """
     Uses Spotify API's 'me' method to get info about current user.
     """
-    if 'access_token' not in session:
-        return redirect(url_for('dashboard'))
-
-    if datetime.now().timestamp() > session['expires_at']:
-        return redirect(url_for('refresh_token'))
+    if not ensure_fresh_token():
+        return redirect(url_for('get_spotify_info'))
 
     headers = {
         "Authorization": f"Bearer {session['access_token']}",
     }
 
-    response = requests.get(BASE_URL + 'me', headers=headers)
+    response = http_client.get(BASE_URL + 'me', headers=headers)
     return response.json()
 
 
+def load_spotify_profile():
+    """
+    Fetch the current user's Spotify profile and remember it, called after login and whenever the token is renewed.
+    """
+    profile = get_user_info()
+    if isinstance(profile, dict) and 'id' in profile:
+        spotify_profile_cache.set(session.get('user_id'), profile)
+        session['spotify_user_id'] = profile['id']
+    return profile
+
+
+def get_spotify_profile():
+    """
+    Get the current user's Spotify profile, only calling GET /me if we haven't cached it.
+    """
+    profile = spotify_profile_cache.get(session.get('user_id'))
+    if profile is None:
+        profile = load_spotify_profile()
+    return profile
+
+
+def get_spotify_user_id():
+    """
+    Get the current user's Spotify user id from the session, falling back to their cached profile.
+    """
+    if 'spotify_user_id' in session:
+        return session['spotify_user_id']
+    profile = get_spotify_profile()
+    return profile.get('id') if isinstance(profile, dict) else None
+
+
 def get_user_playlists():
     """
-    Uses Spotify API's me/playlists method to get the current user's playlists.
+    Uses Spotify API's me/playlists method to get all of the current user's playlists, cached briefly per user.
     """
-    if 'access_token' not in session:
+    if not ensure_fresh_token():
         return None
 
-    if datetime.now().timestamp() > session['expires_at']:
-        refresh_token()
+    cache_key = session.get('user_id')
+    playlists = user_playlists_cache.get(cache_key)
+    if playlists is not None:
+        return playlists
 
     headers = {
         "Authorization": f"Bearer {session['access_token']}"
     }
 
-    response = requests.get(BASE_URL + 'me/playlists', headers=headers)
+    def get_page(offset):
+        return http_client.get(BASE_URL + 'me/playlists', headers=headers,
+                               params={'limit': USER_PLAYLISTS_PAGE_SIZE, 'offset': offset})
 
-    if response.status_code == 200:
-        return response.json().get('items', [])
-    else:
-        print(response.txt)
+    response = get_page(0)
+    if response.status_code != 200:
+        print(response.text)
         return {"error": response.json().get('error', 'Unknown error occurred')}
 
+    first_page = response.json()
+    playlists = list(first_page.get('items', []))
+
+    if 'total' in first_page:
+        # Once we know the total, the remaining pages can all be fetched at the same time
+        offsets = range(USER_PLAYLISTS_PAGE_SIZE,
+                        first_page['total'], USER_PLAYLISTS_PAGE_SIZE)
+        with ThreadPoolExecutor(max_workers=USER_PLAYLISTS_CONCURRENCY) as executor:
+            pages = list(executor.map(get_page, offsets))
+    else:
+        pages = []
+        next_url = first_page.get('next')
+        while next_url:
+            pages.append(http_client.get(next_url, headers=headers))
+            next_url = pages[-1].json().get(
+                'next') if pages[-1].status_code == 200 else None
+
+    complete = True
+    for page in pages:
+        if page.status_code == 200:
+            playlists.extend(page.json().get('items', []))
+        else:
+            complete = False
+
+    # Spotify sometimes returns null entries for playlists it can't show
+    playlists = [playlist for playlist in playlists if playlist]
+    if complete:
+        user_playlists_cache.set(cache_key, playlists)
+    return playlists
+
 
 def create_playlist_helper(name, description, public):
     """
     Sends POST request to Spotify API to create a playlist for the active user from our webpage.
     """
-    user_info = get_user_info()
-    user_id = user_info['id']
-
-    if 'access_token' not in session:
-        return redirect(url_for('dashboard'))
+    if not ensure_fresh_token():
+        return redirect(url_for('get_spotify_info'))
 
-    if datetime.now().timestamp() > session['expires_at']:
-        return redirect(url_for('refresh_token'))
+    user_id = get_spotify_user_id()
 
     headers = {
         "Authorization": f"Bearer {session['access_token']}",
@@ -143,20 +257,21 @@ def create_playlist_helper(name, description, public):
         'public': public,
     }
 
-    response = requests.post(
+    response = http_client.post(
         BASE_URL + f'users/{user_id}/playlists', headers=headers, json=data)
-    return response.json()
+    playlist = response.json()
+    if 'id' in playlist:
+        # The cached playlist list doesn't have the new one yet
+        user_playlists_cache.pop(session.get('user_id'))
+    return playlist
 
 
 def add_to_playlist_helper(playlist_id, track_uri):
     """
     Sends a POST request to Spotify API to add a song to current user's Spotify playlist.
     """
-    if 'access_token' not in session:
-        return redirect(url_for('dashboard'))
-
-    if datetime.now().timestamp() > session['expires_at']:
-        return redirect(url_for(refresh_token))
+    if not ensure_fresh_token():
+        return redirect(url_for('get_spotify_info'))
 
     headers = {
         "Authorization": f"Bearer {session['access_token']}",
@@ -167,10 +282,53 @@ def add_to_playlist_helper(playlist_id, track_uri):
         'uris': [track_uri]
     }
 
-    response = requests.post(
+    response = http_client.post(
         BASE_URL + f'playlists/{playlist_id}/tracks', headers=headers, json=data)
 
     if response.status_code == 200:
+        # The cached playlist list still has the old track counts
+        user_playlists_cache.pop(session.get('user_id'))
         return response.json()  # Success, return the response JSON
     else:
         return {"error": response.json().get('error', 'Unknown error occurred')}
+
+
+def add_tracks_to_playlist(playlist_id, track_uris):
+    """
+    Add many songs to one of the current user's Spotify playlists in batches of 100, returns a result for every batch.
+    Duplicate URIs are dropped, batches are sent in parallel so their order in the playlist isn't guaranteed.
+    """
+    if not ensure_fresh_token():
+        return None
+
+    headers = {
+        "Authorization": f"Bearer {session['access_token']}",
+        "Content-Type": "application/json",
+    }
+
+    uris = list(dict.fromkeys(uri for uri in track_uris if uri))
+    chunks = [uris[i:i + PLAYLIST_ADD_BATCH_SIZE]
+              for i in range(0, len(uris), PLAYLIST_ADD_BATCH_SIZE)]
+
+    def add_chunk(index, chunk):
+        # Retries on 429 (honoring Retry-After) happen inside http_client
+        result = {"chunk": index, "count": len(chunk)}
+        try:
+            response = http_client.post(
+                BASE_URL + f'playlists/{playlist_id}/tracks', headers=headers, json={'uris': chunk})
+            data = response.json()
+        except Exception as e:
+            return dict(result, success=False, error=str(e))
+
+        if response.status_code in (200, 201):
+            return dict(result, success=True, snapshot_id=data.get('snapshot_id'))
+        return dict(result, success=False, error=data.get('error', 'Unknown error occurred'))
+
+    if not chunks:
+        return []
+    with ThreadPoolExecutor(max_workers=min(PLAYLIST_ADD_CONCURRENCY, len(chunks))) as executor:
+        results = list(executor.map(add_chunk, range(len(chunks)), chunks))
+    if any(result['success'] for result in results):
+        # The cached playlist list still has the old track counts
+        user_playlists_cache.pop(session.get('user_id'))
+    return results
@@ -0,0 +1,124 @@
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from genre_cache import get_genres
+from match_the_day import gpt_query_words, GPT_API_KEY
+from match_the_mood import gpt_query_words_mood
+from precomputed_store import write_precomputed_store, PRECOMPUTED_PATH
+from rate_limiter import background_priority
+from recommender import fetch_candidate_pool
+from request_log import get_top_requests, get_request_key
+
+
+class JobRateLimiter:
+    """
+    Spaces out job starts so the batch stays under a fixed number of combinations per second.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate > 0 else 0
+        self._lock = threading.Lock()
+        self._next_start = time.monotonic()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + self.interval
+        time.sleep(start - now)
+
+
+def plan_precompute(limit, genres, seed_moods):
+    """
+    Combinations to precompute: the most requested ones from the request log, then the most requested moods
+    paired with every genre seed, at most limit in total.
+    """
+    logged = [('day', params, hits) for params, hits in get_top_requests('day', limit)]
+    logged += [('mood', params, hits) for params, hits in get_top_requests('mood', limit)]
+    # Most requested first across both features, so a short limit keeps the combinations that matter
+    logged.sort(key=lambda entry: -entry[2])
+    plan = [(kind, params) for kind, params, _ in logged]
+
+    planned = {get_request_key(kind, params) for kind, params in plan}
+    moods = []
+    for kind, params in plan:
+        if kind == 'mood' and params[0] not in moods:
+            moods.append(params[0])
+    for mood in moods[:seed_moods]:
+        for genre in genres:
+            key = get_request_key('mood', [mood, genre])
+            if key not in planned:
+                planned.add(key)
+                plan.append(('mood', [mood, genre]))
+
+    return plan[:limit]
+
+
+def precompute_pool(kind, params):
+    """
+    Run GPT and the Spotify candidate search for one combination, returns its CandidatePool or None.
+    """
+    if kind == 'mood':
+        mood, genre = params
+        query_words = gpt_query_words_mood(mood, GPT_API_KEY)
+    else:
+        temperature, condition, activity, genre = params
+        query_words = gpt_query_words(
+            (temperature, condition), activity, GPT_API_KEY)
+
+    pool, error = fetch_candidate_pool(query_words, genre)
+    if error:
+        print(f"Skipping {kind} {params}: {error}")
+        return None
+    return pool if pool.tracks else None
+
+
+def run_precompute(plan, workers, rate):
+    """
+    Precompute every combination in the plan on a worker pool, returns {request key: CandidatePool}.
+    """
+    limiter = JobRateLimiter(rate)
+
+    def job(kind, params):
+        limiter.wait()
+        try:
+            # Batch work only uses the share of each API budget user requests leave free
+            with background_priority():
+                return precompute_pool(kind, params)
+        except Exception as e:
+            print(f"Error precomputing {kind} {params}: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='precompute') as executor:
+        futures = {get_request_key(kind, params): executor.submit(job, kind, params)
+                   for kind, params in plan}
+        pools = {key: future.result() for key, future in futures.items()}
+    return {key: pool for key, pool in pools.items() if pool is not None}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Precompute candidate pools for the most requested moods, activities and genres.")
+    parser.add_argument('--limit', type=int, default=500,
+                        help="most combinations to precompute")
+    parser.add_argument('--seed-moods', type=int, default=5,
+                        help="top moods to pair with every genre seed")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=1.0,
+                        help="combinations started per second")
+    parser.add_argument('--output', default=PRECOMPUTED_PATH)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    plan = plan_precompute(args.limit, get_genres() or [], args.seed_moods)
+    print(f"Precomputing {len(plan)} combinations")
+
+    pools = run_precompute(plan, args.workers, args.rate)
+    write_precomputed_store(pools, args.output)
+    print(f"Wrote {len(pools)} pools to {args.output} in {time.perf_counter() - start:.1f}s")
+
+
+# Run nightly, e.g. from cron: `python3 precompute.py`
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from dataclasses import fields
+from dotenv import load_dotenv
+from cache import TTLCache
+from recommender import CandidatePool
+from track import Track
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Candidate pools written by precompute.py, read through a memory map so every worker shares the pages
+PRECOMPUTED_PATH = os.getenv('PRECOMPUTED_PATH', 'precomputed.bin')
+# Pools older than this are ignored, the nightly job should have replaced them long before
+PRECOMPUTED_MAX_AGE = int(os.getenv('PRECOMPUTED_MAX_AGE', 3 * 24 * 60 * 60))
+# How often to look for a newer file written by the job
+PRECOMPUTED_RELOAD_INTERVAL = int(
+    os.getenv('PRECOMPUTED_RELOAD_INTERVAL', 60))
+
+# File layout: header, zlib JSON index of key -> [offset, length], then one zlib JSON record per pool
+_MAGIC = b'MMPC'
+_FORMAT_VERSION = 1
+_HEADER = struct.Struct('>4sBQI')
+_TRACK_FIELDS = [field.name for field in fields(Track)]
+
+precomputed_stats = {'hits': 0, 'misses': 0, 'reloads': 0}
+# Decoded pools, so a popular key is only decompressed once
+_decoded_pools = TTLCache(capacity=1000, ttl=PRECOMPUTED_MAX_AGE)
+_store_lock = threading.Lock()
+_store = None
+_checked_at = 0
+
+
+def encode_pool(pool):
+    """
+    Compact JSON form of a CandidatePool, tracks as lists in Track field order.
+    """
+    return {
+        'tracks': [[getattr(track, name) for name in _TRACK_FIELDS] for track in pool.tracks],
+        'popularity': pool.popularity,
+        'consensus': pool.consensus,
+        'genre_match': pool.genre_match,
+    }
+
+
+def decode_pool(record):
+    """
+    CandidatePool back from its encode_pool form.
+    """
+    return CandidatePool(
+        tracks=tuple(Track(*values) for values in record['tracks']),
+        popularity=tuple(record['popularity']),
+        consensus=tuple(record['consensus']),
+        genre_match=tuple(record['genre_match']),
+    )
+
+
+def write_precomputed_store(pools, path=None, generated_at=None):
+    """
+    Write a {key: CandidatePool} dict to the store file, replacing any previous file atomically.
+    """
+    path = path or PRECOMPUTED_PATH
+    generated_at = time.time() if generated_at is None else generated_at
+    index = {}
+    records = []
+    offset = 0
+    for key, pool in pools.items():
+        record = zlib.compress(json.dumps(
+            encode_pool(pool), separators=(',', ':')).encode('utf-8'))
+        index[key] = [offset, len(record)]
+        records.append(record)
+        offset += len(record)
+    index = zlib.compress(json.dumps(index).encode('utf-8'))
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(_MAGIC, _FORMAT_VERSION,
+                int(generated_at), len(index)))
+        f.write(index)
+        for record in records:
+            f.write(record)
+    # Workers still holding the old file keep reading it until they reload
+    os.replace(tmp_path, path)
+
+
+class PrecomputedStore:
+    """
+    Read-only view of a store file, the index is loaded up front and pools are decoded on demand.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.generated_at = 0
+        self.mtime = 0
+        self._entries = {}
+        self._mmap = None
+        self._data_start = 0
+        try:
+            with open(path, 'rb') as f:
+                self.mtime = os.fstat(f.fileno()).st_mtime
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, generated_at, index_length = _HEADER.unpack_from(
+                self._mmap)
+            if magic != _MAGIC or version != _FORMAT_VERSION:
+                raise ValueError(f"unknown format {magic!r} v{version}")
+            self._data_start = _HEADER.size + index_length
+            self._entries = json.loads(zlib.decompress(
+                self._mmap[_HEADER.size:self._data_start]))
+            self.generated_at = generated_at
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, struct.error, zlib.error) as e:
+            print(f"Error loading precomputed store {path}: {e}")
+            self.close()
+
+    def get(self, key):
+        """
+        The CandidatePool stored under key, or None if there isn't one.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        start = self._data_start + entry[0]
+        return decode_pool(json.loads(zlib.decompress(self._mmap[start:start + entry[1]])))
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def load_precomputed_store(path=None):
+    """
+    Map the store file into memory, called at startup and whenever the nightly job has written a newer file.
+    """
+    global _store, _checked_at
+    store = PrecomputedStore(path or PRECOMPUTED_PATH)
+    with _store_lock:
+        # The old map isn't closed here, a request may still be reading it, it is unmapped once unreferenced
+        _store = store
+        _checked_at = time.time()
+        _decoded_pools.clear()
+        precomputed_stats['reloads'] += 1
+    return store
+
+
+def get_store():
+    """
+    The current store, reloaded if PRECOMPUTED_RELOAD_INTERVAL has passed and the file changed.
+    """
+    global _checked_at
+    store = _store
+    if store is None:
+        return load_precomputed_store()
+    if time.time() - _checked_at < PRECOMPUTED_RELOAD_INTERVAL:
+        return store
+    _checked_at = time.time()
+    try:
+        mtime = os.stat(store.path).st_mtime
+    except OSError:
+        mtime = 0
+    if mtime != store.mtime:
+        return load_precomputed_store(store.path)
+    return store
+
+
+def get_precomputed_pool(key):
+    """
+    The precomputed CandidatePool for a request key, or None if the nightly job didn't cover it.
+    """
+    pool = _decoded_pools.get(key)
+    if pool is None:
+        store = get_store()
+        if store.generated_at < time.time() - PRECOMPUTED_MAX_AGE:
+            precomputed_stats['misses'] += 1
+            return None
+        try:
+            pool = store.get(key)
+        except (ValueError, zlib.error) as e:
+            print(f"Error reading precomputed pool {key}: {e}")
+            pool = None
+        if pool is None:
+            precomputed_stats['misses'] += 1
+            return None
+        _decoded_pools.set(key, pool)
+    precomputed_stats['hits'] += 1
+    return pool
@@ -0,0 +1,227 @@
+import contextvars
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from dotenv import load_dotenv
+from cache import CACHE_DB_PATH
+from db import get_db_connection
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Requests per second and burst size for each upstream, shared by every worker process through SQLite
+UPSTREAM_LIMITS = {
+    'spotify': (float(os.getenv('SPOTIFY_RATE_LIMIT', 10)), float(os.getenv('SPOTIFY_RATE_BURST', 30))),
+    'openai': (float(os.getenv('OPENAI_RATE_LIMIT', 3)), float(os.getenv('OPENAI_RATE_BURST', 10))),
+    'weather': (float(os.getenv('WEATHER_RATE_LIMIT', 1)), float(os.getenv('WEATHER_RATE_BURST', 10))),
+}
+RATE_LIMIT_DB_PATH = os.getenv('RATE_LIMIT_DB_PATH', CACHE_DB_PATH)
+# How long a call may queue for a token before we give up and degrade
+RATE_LIMIT_MAX_WAIT = float(os.getenv('RATE_LIMIT_MAX_WAIT', 2))
+RATE_LIMIT_BACKGROUND_MAX_WAIT = float(
+    os.getenv('RATE_LIMIT_BACKGROUND_MAX_WAIT', 30))
+# Share of each burst background work may not touch, so prefetches never starve user requests
+RATE_LIMIT_BACKGROUND_RESERVE = float(
+    os.getenv('RATE_LIMIT_BACKGROUND_RESERVE', 0.25))
+
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+_priority = contextvars.ContextVar('rate_limit_priority', default=INTERACTIVE)
+
+_buckets_lock = threading.Lock()
+_buckets = {}
+_tables_created = set()
+
+
+class RateLimitExceeded(Exception):
+    """
+    Raised when a call couldn't get a token from its upstream's budget in time.
+    """
+
+    def __init__(self, upstream):
+        super().__init__(f"{upstream} request budget exhausted")
+        self.upstream = upstream
+
+
+@contextmanager
+def background_priority():
+    """
+    Calls made inside this block are background work, they queue longer and leave a reserve for user requests.
+    """
+    token = _priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def get_priority():
+    """
+    Priority of calls made from the current context, INTERACTIVE unless inside background_priority.
+    """
+    return _priority.get()
+
+
+class TokenBucket:
+    """
+    Token bucket for one upstream, its state lives in SQLite so every worker process draws from the same budget.
+    """
+
+    def __init__(self, upstream, rate, burst, db_path=None):
+        self.upstream = upstream
+        self.rate = rate
+        self.burst = burst
+        self.db_path = db_path or RATE_LIMIT_DB_PATH
+        self._stats_lock = threading.Lock()
+        self.stats = {'acquired': 0, 'waited': 0, 'wait_seconds': 0.0, 'rejected': 0,
+                      'background_acquired': 0, 'backoffs': 0}
+
+    def _get_connection(self):
+        conn = get_db_connection(self.db_path)
+        if self.db_path not in _tables_created:
+            conn.execute('''CREATE TABLE IF NOT EXISTS rate_limits (
+                                upstream TEXT PRIMARY KEY,
+                                tokens REAL NOT NULL,
+                                updated_at REAL NOT NULL
+                            )''')
+            conn.commit()
+            _tables_created.add(self.db_path)
+        return conn
+
+    def _update(self, change):
+        """
+        Refill the bucket and apply change(tokens, now, updated_at) -> (tokens, updated_at, result) in one write transaction.
+        """
+        conn = self._get_connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            row = conn.execute('SELECT tokens, updated_at FROM rate_limits WHERE upstream=?',
+                               (self.upstream,)).fetchone()
+            if row is None:
+                tokens, updated_at = self.burst, now
+            else:
+                # updated_at is in the future while backing off after a 429, nothing refills until then
+                refilled = max(0.0, now - row['updated_at']) * self.rate
+                tokens = min(self.burst, row['tokens'] + refilled)
+                updated_at = max(now, row['updated_at'])
+            tokens, updated_at, result = change(tokens, now, updated_at)
+            conn.execute('INSERT OR REPLACE INTO rate_limits (upstream, tokens, updated_at) VALUES (?, ?, ?)',
+                         (self.upstream, tokens, updated_at))
+            conn.commit()
+            return result
+        except Exception:
+            conn.rollback()
+            raise
+
+    def _take(self, reserve):
+        """
+        Take one token if more than reserve are left, returns 0 on success or roughly how long to wait.
+        """
+        def change(tokens, now, updated_at):
+            needed = 1 + reserve
+            if tokens >= needed:
+                return tokens - 1, updated_at, 0
+            return tokens, updated_at, (needed - tokens) / self.rate + (updated_at - now)
+        return self._update(change)
+
+    def acquire(self, priority=None, max_wait=None):
+        """
+        Wait for a token, background work only gets one while the interactive reserve is untouched.
+        Returns False if none was free within max_wait.
+        """
+        priority = priority or get_priority()
+        background = priority == BACKGROUND
+        reserve = self.burst * RATE_LIMIT_BACKGROUND_RESERVE if background else 0
+        if max_wait is None:
+            max_wait = RATE_LIMIT_BACKGROUND_MAX_WAIT if background else RATE_LIMIT_MAX_WAIT
+
+        started = time.monotonic()
+        while True:
+            wait = self._take(reserve)
+            waited = time.monotonic() - started
+            if wait == 0:
+                with self._stats_lock:
+                    self.stats['acquired'] += 1
+                    if background:
+                        self.stats['background_acquired'] += 1
+                    if waited > 0:
+                        self.stats['waited'] += 1
+                        self.stats['wait_seconds'] += waited
+                return True
+            remaining = max_wait - waited
+            if remaining <= 0:
+                with self._stats_lock:
+                    self.stats['rejected'] += 1
+                return False
+            # Jitter so workers queued on the same bucket don't all retry at the same instant
+            time.sleep(min(wait, remaining) + random.uniform(0, 0.01))
+
+    def backoff(self, seconds):
+        """
+        Empty the bucket and stop refilling it for seconds, used when the upstream answers 429 anyway.
+        """
+        self._update(lambda tokens, now, updated_at: (
+            0.0, max(updated_at, now + seconds), None))
+        with self._stats_lock:
+            self.stats['backoffs'] += 1
+
+    def get_tokens(self):
+        """
+        Tokens left right now, shared by every process.
+        """
+        return self._update(lambda tokens, now, updated_at: (tokens, updated_at, tokens))
+
+    def get_stats(self):
+        """
+        This process's counters along with the shared number of tokens left.
+        """
+        with self._stats_lock:
+            stats = dict(self.stats)
+        return dict(stats, tokens=self.get_tokens(), rate=self.rate, burst=self.burst)
+
+
+def get_bucket(upstream):
+    """
+    Shared TokenBucket for an upstream in UPSTREAM_LIMITS.
+    """
+    bucket = _buckets.get(upstream)
+    if bucket is None:
+        with _buckets_lock:
+            bucket = _buckets.get(upstream)
+            if bucket is None:
+                rate, burst = UPSTREAM_LIMITS[upstream]
+                bucket = _buckets[upstream] = TokenBucket(
+                    upstream, rate, burst)
+    return bucket
+
+
+def acquire(upstream, priority=None, max_wait=None):
+    """
+    Take one call from an upstream's budget, returns False if it is exhausted. Never raises on SQLite errors.
+    """
+    try:
+        return get_bucket(upstream).acquire(priority, max_wait)
+    except Exception as e:
+        # A broken limiter shouldn't take the site down with it
+        print(f"Error checking {upstream} rate limit: {e}")
+        return True
+
+
+def backoff(upstream, seconds):
+    """
+    Pause an upstream's budget after it answered 429.
+    """
+    try:
+        get_bucket(upstream).backoff(seconds)
+    except Exception as e:
+        print(f"Error backing off {upstream} rate limit: {e}")
+
+
+def get_rate_limit_stats():
+    """
+    Budget usage counters for every upstream.
+    """
+    return {upstream: get_bucket(upstream).get_stats() for upstream in UPSTREAM_LIMITS}
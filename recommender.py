@@ -0,0 +1,216 @@
+import contextvars
+import os
+import random
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from dotenv import load_dotenv
+from flask import flash
+from cache import TTLCache, normalize_text, STALE_CACHE_TTL
+from songs import build_search_query, search_spotify_playlists, get_playlist_tracks
+from single_flight import single_flight
+from track import parse_playlist_items
+
+try:
+    import numpy as np
+except ImportError:
+    # Without numpy candidates are scored in plain Python, same results only slower
+    np = None
+
+# Load environment variables from .env file
+load_dotenv()
+
+# How many songs we recommend and how many playlists feed the candidate pool
+RECOMMENDATION_COUNT = int(os.getenv('RECOMMENDATION_COUNT', 6))
+CANDIDATE_PLAYLIST_LIMIT = int(os.getenv('CANDIDATE_PLAYLIST_LIMIT', 10))
+CANDIDATE_FETCH_TIMEOUT = float(os.getenv('CANDIDATE_FETCH_TIMEOUT', 8))
+CANDIDATE_FETCH_WORKERS = int(os.getenv('CANDIDATE_FETCH_WORKERS', 8))
+CANDIDATE_POOL_TTL = int(os.getenv('CANDIDATE_POOL_TTL', 60 * 60))
+CANDIDATE_POOL_CAPACITY = int(os.getenv('CANDIDATE_POOL_CAPACITY', 2000))
+
+# Ranking weights, jitter keeps repeat visits from always getting the same six songs
+POPULARITY_WEIGHT = float(os.getenv('RECOMMEND_POPULARITY_WEIGHT', 0.3))
+CONSENSUS_WEIGHT = float(os.getenv('RECOMMEND_CONSENSUS_WEIGHT', 0.4))
+GENRE_WEIGHT = float(os.getenv('RECOMMEND_GENRE_WEIGHT', 0.3))
+RECOMMEND_JITTER = float(os.getenv('RECOMMEND_JITTER', 0.3))
+# Subtracted from an artist's other tracks each time one of theirs is picked
+ARTIST_REPEAT_PENALTY = float(os.getenv('RECOMMEND_ARTIST_PENALTY', 0.5))
+
+# Maps a normalized search query to its CandidatePool
+candidate_pool_cache = TTLCache(
+    capacity=CANDIDATE_POOL_CAPACITY, ttl=CANDIDATE_POOL_TTL, stale_ttl=STALE_CACHE_TTL)
+
+_candidate_executor = ThreadPoolExecutor(
+    max_workers=CANDIDATE_FETCH_WORKERS, thread_name_prefix='candidate-fetch')
+
+# "(Remastered 2011)", "[Live]", " - Radio Edit" and the like
+_TITLE_VERSION = re.compile(r"\s*[\(\[][^\)\]]*[\)\]]|\s+-\s+.*$")
+
+
+@dataclass(frozen=True, slots=True)
+class CandidatePool:
+    """
+    Deduplicated tracks from every playlist a search found, with the per-track features used to rank them.
+    """
+    tracks: tuple
+    # Spotify popularity scaled to 0-1
+    popularity: tuple
+    # How many of the playlists had the track, relative to the most shared track
+    consensus: tuple
+    # 1.0 if a playlist the track came from mentions the genre in its name or description
+    genre_match: tuple
+
+
+def get_song_key(track):
+    """
+    Artist and title with version suffixes stripped, so remasters and live cuts count as the same song.
+    """
+    return normalize_text(track.artist_name), normalize_text(_TITLE_VERSION.sub('', track.song_name))
+
+
+def build_candidate_pool(sources, genre):
+    """
+    Merge (playlist, tracks) pairs into one CandidatePool, deduplicating by URI and by artist and title.
+    """
+    genre = normalize_text(genre or '')
+    entries = {}
+    for playlist, tracks in sources:
+        playlist = playlist or {}
+        mentions_genre = bool(genre) and genre in normalize_text(
+            f"{playlist.get('name') or ''} {playlist.get('description') or ''}")
+        seen_here = set()
+        for track in parse_playlist_items(tracks):
+            # The same URI always gives the same key, so this covers exact duplicates too
+            key = get_song_key(track)
+            if key in seen_here:
+                continue
+            seen_here.add(key)
+            entry = entries.get(key)
+            if entry is None:
+                entries[key] = [track, 1, mentions_genre]
+            else:
+                entry[1] += 1
+                entry[2] = entry[2] or mentions_genre
+
+    most_shared = max((entry[1] for entry in entries.values()), default=1)
+    values = list(entries.values())
+    return CandidatePool(
+        tracks=tuple(entry[0] for entry in values),
+        popularity=tuple((entry[0].popularity or 0) / 100 for entry in values),
+        consensus=tuple(entry[1] / most_shared for entry in values),
+        genre_match=tuple(1.0 if entry[2] else 0.0 for entry in values),
+    )
+
+
+@single_flight(build_search_query)
+def fetch_candidate_pool(query_words, genre):
+    """
+    Candidate pool for a search, fetching every playlist it found concurrently.
+    Returns (pool, None), or (None, error message) if the search failed. Safe to call outside a request.
+    """
+    query = build_search_query(query_words, genre)
+    pool = candidate_pool_cache.get(query)
+    if pool is not None:
+        return pool, None
+
+    data = search_spotify_playlists(query, limit=CANDIDATE_PLAYLIST_LIMIT)
+    if "error" in data:
+        # An expired pool is still a good answer while Spotify is failing or we're out of budget
+        pool = candidate_pool_cache.get_stale(query)
+        return (pool, None) if pool is not None else (None, data['error']['message'])
+
+    # Spotify sometimes returns null entries for playlists it can't show
+    playlists = [playlist for playlist in data['playlists']['items'] if playlist]
+    if not playlists:
+        return None, "No playlist found that matches critera"
+
+    # Fetches run with the caller's context, so background work keeps its rate limit priority
+    futures = [(playlist, _candidate_executor.submit(contextvars.copy_context().run, get_playlist_tracks,
+                                                     playlist['id'], playlist.get('snapshot_id')))
+               for playlist in playlists]
+    deadline = time.monotonic() + CANDIDATE_FETCH_TIMEOUT
+    sources = []
+    for playlist, future in futures:
+        try:
+            # Slow playlists are left out of this answer, they still land in the playlist cache for next time
+            playlist_data = future.result(
+                timeout=max(0, deadline - time.monotonic()))
+        except Exception as e:
+            print(f"Error fetching candidate playlist {playlist['id']}: {e}")
+            continue
+        if "error" not in playlist_data:
+            sources.append((playlist, playlist_data['items']))
+
+    pool = build_candidate_pool(sources, genre)
+    # Only complete pools are cached, a partial one would hide the missing playlists for the whole TTL
+    if len(sources) == len(playlists):
+        candidate_pool_cache.set(query, pool)
+    return pool, None
+
+
+def get_candidate_pool(query_words, genre):
+    """
+    Candidate pool for a search, flashing Spotify's error and returning None if the search failed.
+    """
+    pool, error = fetch_candidate_pool(query_words, genre)
+    if error:
+        flash(
+            f"Sorry, there was an error. Please try again. Error from Spotify API: {error}", "error")
+    return pool
+
+
+def rank_candidates(pool, limit=None):
+    """
+    Pick limit tracks from the pool by weighted score, greedily penalising artists that were already picked.
+    """
+    limit = RECOMMENDATION_COUNT if limit is None else limit
+    count = len(pool.tracks)
+    artist_ids = {}
+    artists = [artist_ids.setdefault(normalize_text(track.artist_name), len(artist_ids))
+               for track in pool.tracks]
+    chosen = []
+
+    if np is not None:
+        # Whole pool scored at once, one weighted sum per feature column
+        scores = POPULARITY_WEIGHT * np.asarray(pool.popularity, dtype=np.float64)
+        scores += CONSENSUS_WEIGHT * np.asarray(pool.consensus, dtype=np.float64)
+        scores += GENRE_WEIGHT * np.asarray(pool.genre_match, dtype=np.float64)
+        scores += RECOMMEND_JITTER * np.random.default_rng().random(count)
+        artists = np.asarray(artists, dtype=np.intp)
+        picked = np.zeros(len(artist_ids))
+        for _ in range(min(limit, count)):
+            best = int(np.argmax(scores - ARTIST_REPEAT_PENALTY * picked[artists]))
+            chosen.append(best)
+            picked[artists[best]] += 1
+            scores[best] = -np.inf
+    else:
+        scores = [POPULARITY_WEIGHT * popularity + CONSENSUS_WEIGHT * consensus + GENRE_WEIGHT * genre_match + RECOMMEND_JITTER * random.random()
+                  for popularity, consensus, genre_match in zip(pool.popularity, pool.consensus, pool.genre_match)]
+        picked = [0] * len(artist_ids)
+        for _ in range(min(limit, count)):
+            best = max((i for i in range(count) if scores[i] is not None),
+                       key=lambda i: scores[i] - ARTIST_REPEAT_PENALTY * picked[artists[i]])
+            chosen.append(best)
+            picked[artists[best]] += 1
+            scores[best] = None
+
+    return {i + 1: pool.tracks[index] for i, index in enumerate(chosen)}
+
+
+def recommend_songs(query_words, genre, playlist=None):
+    """
+    Recommend songs for GPT's query words and a genre, ranked from the tracks of every playlist the search found.
+    Pass playlist to rank tracks that were already fetched instead.
+    """
+    if playlist is not None:
+        pool = build_candidate_pool([(None, playlist)], genre)
+    else:
+        pool = get_candidate_pool(query_words, genre)
+        if pool is None:
+            return {}
+
+    if not pool.tracks:
+        flash("Sorry, No tracks found.", "error")
+        return {}
+    return rank_candidates(pool)
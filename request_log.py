@@ -0,0 +1,44 @@
+import json
+import os
+import sqlite3
+import time
+from dotenv import load_dotenv
+from db import get_db_connection
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Only requests seen within this many seconds count towards the precompute job's top combinations
+REQUEST_LOG_WINDOW = int(os.getenv('REQUEST_LOG_WINDOW', 30 * 24 * 60 * 60))
+
+
+def get_request_key(kind, params):
+    """
+    Key a recommendation request is stored under, shared by the request log and the precomputed store.
+    """
+    return json.dumps([kind] + list(params))
+
+
+def log_request(kind, params):
+    """
+    Count one recommendation request, params are the normalized inputs that decide its result.
+    """
+    conn = get_db_connection()
+    try:
+        conn.execute('''INSERT INTO request_log (kind, params, hits, last_seen) VALUES (?, ?, 1, ?)
+                        ON CONFLICT (kind, params) DO UPDATE SET hits=hits+1, last_seen=excluded.last_seen''',
+                     (kind, json.dumps(list(params)), time.time()))
+        conn.commit()
+    except sqlite3.Error as e:
+        print(f"Error logging request: {e}")
+        conn.rollback()
+
+
+def get_top_requests(kind, limit):
+    """
+    (params, hits) for the most requested params of a kind seen within REQUEST_LOG_WINDOW, most popular first.
+    """
+    rows = get_db_connection().execute('''SELECT params, hits FROM request_log WHERE kind=? AND last_seen>=?
+                                          ORDER BY hits DESC LIMIT ?''',
+                                       (kind, time.time() - REQUEST_LOG_WINDOW, limit)).fetchall()
+    return [(json.loads(row['params']), row['hits']) for row in rows]
@@ -0,0 +1,38 @@
+import os
+import secrets
+from dotenv import load_dotenv
+from cache import PersistentCache
+from track import Track
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Recommendation results are kept server-side so revisiting a result page doesn't rerun the pipeline
+RESULT_CACHE_TTL = int(os.getenv('RESULT_CACHE_TTL', 60 * 60))
+RESULT_CACHE_CAPACITY = int(os.getenv('RESULT_CACHE_CAPACITY', 20000))
+result_cache = PersistentCache('recommendation_results',
+                               capacity=RESULT_CACHE_CAPACITY, ttl=RESULT_CACHE_TTL)
+
+
+def store_result(user_id, songs, context):
+    """
+    Save a user's song matches along with what the template needs to show them, returns the new result id.
+    """
+    result_id = secrets.token_urlsafe(12)
+    result_cache.set(result_id, {
+        'user_id': user_id,
+        'songs': [song.to_dict() if isinstance(song, Track) else dict(song) for song in songs.values()],
+        'context': context,
+    })
+    return result_id
+
+
+def load_result(user_id, result_id):
+    """
+    Get a stored result as (songs, context), or (None, None) if it expired or belongs to another user.
+    """
+    result = result_cache.get(result_id) if result_id else None
+    if result is None or result['user_id'] != user_id:
+        return None, None
+    songs = {i + 1: Track(**song) for i, song in enumerate(result['songs'])}
+    return songs, result['context']
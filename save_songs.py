@@ -1,37 +1,26 @@
 import sqlite3
+from db import get_db_connection
 from dotenv import load_dotenv
 import os
 from songs import *
+from track import Track
+from track_index import track_index
 load_dotenv()
 
-
-def get_db_connection():
-    """
-    Function to connect to SQLite database.
-    """
-    conn = sqlite3.connect('users.db')
-    conn.row_factory = sqlite3.Row  # Allows fetching rows as dictionaries
-    return conn
+# How many saved songs to load per query for the saved songs page and API
+SAVED_SONGS_PAGE_SIZE = int(os.getenv('SAVED_SONGS_PAGE_SIZE', 50))
+SAVED_SONGS_MAX_PAGE_SIZE = int(os.getenv('SAVED_SONGS_MAX_PAGE_SIZE', 200))
 
 
-def create_saved_songs_table():
+def index_saved_songs(user_id, songs):
     """
-    Create saved_songs table if not exists, include all necessary info for interacting with spotify api.
+    Add saved songs to the local track index, songs one user saves count as related to each other.
     """
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS saved_songs (
-                   id INTEGER PRIMARY KEY AUTOINCREMENT,
-                   song_name TEXT NOT NULL,
-                   artist_name TEXT NOT NULL,
-                   album_name TEXT,
-                   song_link TEXT NOT NULL,
-                   uri TEXT NOT NULL,
-                   user_id INTEGER,
-                   FOREIGN KEY (user_id) REFERENCES users(user_id)
-               )''')
-    conn.commit()
-    conn.close()
+    track_index.add_tracks((Track(song_name=song['song_name'], artist_name=song['artist_name'],
+                                  album_name=song.get('album_name'), song_link=song['song_link'],
+                                  album_cover=song.get('album_cover'), popularity=song.get('popularity') or 0,
+                                  uri=song['uri'])
+                            for song in songs), context=f"saved:{user_id}")
 
 
 def save_song(user_id, song_name, artist_name, album_name, song_link, uri):
@@ -42,13 +31,41 @@ def save_song(user_id, song_name, artist_name, album_name, song_link, uri):
     c = conn.cursor()
     try:
         c.execute('''INSERT INTO saved_songs (song_name, artist_name, album_name, song_link, uri, user_id)
-                     VALUES (?, ?, ?, ?, ?, ?)''', (song_name, artist_name, album_name, song_link, uri, user_id))
+                     VALUES (?, ?, ?, ?, ?, ?)
+                     ON CONFLICT (user_id, uri) DO NOTHING''', (song_name, artist_name, album_name, song_link, uri, user_id))
         conn.commit()
+        if c.rowcount == 0:
+            # Already saved, hand back the existing row's id
+            c.execute("SELECT id FROM saved_songs WHERE user_id=? AND uri=?",
+                      (user_id, uri))
+            return c.fetchone()['id']
         song_id = c.lastrowid
-        conn.close()
+        index_saved_songs(user_id, [{'song_name': song_name, 'artist_name': artist_name, 'album_name': album_name,
+                                     'song_link': song_link, 'uri': uri}])
         return song_id
     except sqlite3.IntegrityError as e:
-        conn.close()
+        conn.rollback()
+        return None
+
+
+def save_songs_bulk(user_id, songs):
+    """
+    Save many songs for a user in one transaction, songs already saved are skipped. Returns how many were added.
+    """
+    rows = [(song['song_name'], song['artist_name'], song.get('album_name'), song['song_link'], song['uri'], user_id)
+            for song in songs]
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        c.executemany('''INSERT INTO saved_songs (song_name, artist_name, album_name, song_link, uri, user_id)
+                         VALUES (?, ?, ?, ?, ?, ?)
+                         ON CONFLICT (user_id, uri) DO NOTHING''', rows)
+        conn.commit()
+        index_saved_songs(user_id, songs)
+        return c.rowcount
+    except sqlite3.Error as e:
+        print(f"Error saving songs: {e}")
+        conn.rollback()
         return None
 
 
@@ -58,12 +75,61 @@ def get_saved_songs(user_id):
     """
     conn = get_db_connection()
     c = conn.cursor()
-    c.execute('''SELECT * FROM saved_songs WHERE user_id=?''', (user_id,))
+    c.execute('''SELECT * FROM saved_songs WHERE user_id=? ORDER BY id''', (user_id,))
     saved_songs = c.fetchall()
-    conn.close()
     return saved_songs
 
 
+def get_saved_songs_page(user_id, before_id=None, limit=None):
+    """
+    Get one page of a user's saved songs newest first, pass the last id of the previous page as before_id.
+    """
+    limit = min(limit or SAVED_SONGS_PAGE_SIZE, SAVED_SONGS_MAX_PAGE_SIZE)
+    conn = get_db_connection()
+    c = conn.cursor()
+    # Keyset pagination walks the (user_id, id) index, so every page costs the same no matter how deep
+    if before_id is None:
+        c.execute('''SELECT * FROM saved_songs WHERE user_id=?
+                     ORDER BY id DESC LIMIT ?''', (user_id, limit))
+    else:
+        c.execute('''SELECT * FROM saved_songs WHERE user_id=? AND id<?
+                     ORDER BY id DESC LIMIT ?''', (user_id, before_id, limit))
+    return c.fetchall()
+
+
+def iter_saved_songs(user_id, page_size=None):
+    """
+    Yield all of a user's saved songs newest first, loading one page at a time so the whole library is never in memory.
+    """
+    page_size = min(page_size or SAVED_SONGS_PAGE_SIZE,
+                    SAVED_SONGS_MAX_PAGE_SIZE)
+    before_id = None
+    while True:
+        page = get_saved_songs_page(user_id, before_id, page_size)
+        yield from page
+        if len(page) < page_size:
+            return
+        before_id = page[-1]['id']
+
+
+def get_saved_song_uris(user_id, song_ids):
+    """
+    Look up the Spotify URIs of some of a user's saved songs by their ids.
+    """
+    song_ids = list(song_ids)
+    conn = get_db_connection()
+    c = conn.cursor()
+    uris = []
+    # Stay well under SQLite's limit on query parameters
+    for i in range(0, len(song_ids), 500):
+        batch = song_ids[i:i + 500]
+        placeholders = ', '.join('?' * len(batch))
+        c.execute(f'''SELECT uri FROM saved_songs WHERE user_id=? AND id IN ({placeholders})
+                      ORDER BY id''', (user_id, *batch))
+        uris.extend(row['uri'] for row in c.fetchall())
+    return uris
+
+
 def delete_saved_song_by_id(user_id, song_id):
     """
     Delete a saved song, needs song's id.
@@ -74,31 +140,8 @@ def delete_saved_song_by_id(user_id, song_id):
         c.execute("DELETE FROM saved_songs WHERE id=? AND user_id=?",
                   (song_id, user_id))
         conn.commit()
-        conn.close()
         return True
     except sqlite3.Error as e:
         print(f"Error deleting song: {e}")
-        conn.close()
+        conn.rollback()
         return False
-
-
-def create_playlists_table():
-    """
-    Create playlist table with necessary info to interact with Spotify API.
-    """
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS playlists (
-                   id INTEGER PRIMARY KEY AUTOINCREMENT,
-                   playlist_id TEXT NOT NULL,
-                   playlist_name TEXT NOT NULL,
-                   user_id INTEGER,
-                   FOREIGN KEY (user_id) REFERENCES users(user_id)
-               )''')
-    conn.commit()
-    conn.close()
-
-
-# Call this function to create tables if they don't exist yet
-if __name__ == "__main__":
-    create_saved_songs_table()
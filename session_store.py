@@ -0,0 +1,228 @@
+import os
+import secrets
+import threading
+import time
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+from dotenv import load_dotenv
+from db import get_db_connection
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Session data lives on the server, the cookie only carries a random session id
+SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'sqlite')
+SESSION_DB_PATH = os.getenv('SESSION_DB_PATH', 'sessions.db')
+SESSION_SWEEP_INTERVAL = int(os.getenv('SESSION_SWEEP_INTERVAL', 10 * 60))
+
+# Same serializer Flask uses for its cookie sessions, so tuples, bytes etc. survive the round trip
+_serializer = TaggedJSONSerializer()
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """
+    Session whose data is only loaded from the backend the first time a request actually reads or writes it.
+    """
+
+    def __init__(self, sid, loader=None, new=False):
+        def on_update(self):
+            self.modified = True
+            self.accessed = True
+
+        super().__init__(None, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.accessed = False
+        # Set to get a fresh id when the session is saved
+        self.regenerated = False
+        self._loader = loader
+        self.loaded = loader is None
+
+    def load(self):
+        if not self.loaded:
+            self.loaded = True
+            self.accessed = True
+            data = self._loader()
+            if data is None:
+                # Unknown or expired id, never adopt an id the browser picked
+                self.regenerated = True
+            # dict.update skips on_update, loading isn't a modification
+            dict.update(self, data or {})
+
+    def regenerate(self):
+        """
+        Move the session to a fresh id when it's saved and delete the old one, call on login and logout.
+        """
+        self.load()
+        self.regenerated = True
+        self.modified = True
+
+
+def _loads_first(name):
+    method = getattr(CallbackDict, name)
+
+    def wrapper(self, *args, **kwargs):
+        self.load()
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = name
+    return wrapper
+
+
+for _name in ('__getitem__', '__setitem__', '__delitem__', '__contains__', '__iter__', '__len__', '__bool__',
+              '__repr__', 'get', 'keys', 'items', 'values', 'pop', 'popitem', 'setdefault', 'update', 'clear', 'copy'):
+    if hasattr(CallbackDict, _name):
+        setattr(ServerSideSession, _name, _loads_first(_name))
+
+
+class MemorySessionBackend:
+    """
+    Keeps sessions in a dict, only meant for tests and single process development.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+    def get(self, sid):
+        with self._lock:
+            entry = self._sessions.get(sid)
+        if entry is None or entry[0] < time.time():
+            return None
+        return _serializer.loads(entry[1])
+
+    def set(self, sid, data, expires_at):
+        with self._lock:
+            self._sessions[sid] = (expires_at, _serializer.dumps(data))
+
+    def delete(self, sid):
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+    def sweep(self):
+        now = time.time()
+        with self._lock:
+            expired = [sid for sid, entry in self._sessions.items()
+                       if entry[0] < now]
+            for sid in expired:
+                del self._sessions[sid]
+        return len(expired)
+
+
+class SQLiteSessionBackend:
+    """
+    Stores sessions in SQLite so every worker process sees the same sessions.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or SESSION_DB_PATH
+        conn = get_db_connection(self.path)
+        conn.execute('''CREATE TABLE IF NOT EXISTS sessions (
+                            sid TEXT PRIMARY KEY,
+                            data TEXT NOT NULL,
+                            expires_at REAL NOT NULL
+                        )''')
+        conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_sessions_expires_at ON sessions (expires_at)')
+        conn.commit()
+
+    def get(self, sid):
+        row = get_db_connection(self.path).execute('SELECT data FROM sessions WHERE sid=? AND expires_at>=?',
+                                                   (sid, time.time())).fetchone()
+        return None if row is None else _serializer.loads(row['data'])
+
+    def set(self, sid, data, expires_at):
+        conn = get_db_connection(self.path)
+        conn.execute('INSERT OR REPLACE INTO sessions (sid, data, expires_at) VALUES (?, ?, ?)',
+                     (sid, _serializer.dumps(data), expires_at))
+        conn.commit()
+
+    def delete(self, sid):
+        conn = get_db_connection(self.path)
+        conn.execute('DELETE FROM sessions WHERE sid=?', (sid,))
+        conn.commit()
+
+    def sweep(self):
+        conn = get_db_connection(self.path)
+        deleted = conn.execute(
+            'DELETE FROM sessions WHERE expires_at<?', (time.time(),)).rowcount
+        conn.commit()
+        return deleted
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """
+    Flask session interface that keeps session data in a backend and only sends an opaque id to the browser.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._last_sweep = time.time()
+
+    def new_sid(self):
+        return secrets.token_urlsafe(32)
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if not sid:
+            return ServerSideSession(self.new_sid(), new=True)
+        return ServerSideSession(sid, loader=lambda: self.backend.get(sid))
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        self.sweep_if_due()
+
+        # Nothing read or written means nothing to save, the store is never touched
+        if not session.loaded:
+            return
+
+        if session.regenerated:
+            # Whatever id the browser had before is worthless from here on
+            self.backend.delete(session.sid)
+            session.sid = self.new_sid()
+            session.new = True
+
+        if not session:
+            if session.modified:
+                # Emptied (logout/home), so throw the id away rather than reuse it
+                self.backend.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if not session.modified and not session.new:
+            return
+
+        expires_at = time.time() + app.permanent_session_lifetime.total_seconds()
+        self.backend.set(session.sid, dict(session), expires_at)
+        response.set_cookie(name, session.sid,
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path,
+                            secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
+
+    def sweep_if_due(self):
+        """
+        Delete expired sessions every SESSION_SWEEP_INTERVAL seconds.
+        """
+        if time.time() - self._last_sweep < SESSION_SWEEP_INTERVAL:
+            return
+        self._last_sweep = time.time()
+        try:
+            self.backend.sweep()
+        except Exception as e:
+            print(f"Error sweeping sessions: {e}")
+
+
+def create_session_interface(backend_name=None):
+    """
+    Build the session interface for SESSION_BACKEND, 'sqlite' (default) or 'memory'.
+    """
+    backend_name = backend_name or SESSION_BACKEND
+    if backend_name == 'memory':
+        return ServerSideSessionInterface(MemorySessionBackend())
+    return ServerSideSessionInterface(SQLiteSessionBackend())
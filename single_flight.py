@@ -0,0 +1,92 @@
+import functools
+import threading
+from concurrent.futures import Future
+from flask import flash, has_request_context, message_flashed
+
+# Flashes made by a leader thread while it runs, so followers in other requests can show the same messages
+_recording = threading.local()
+
+
+def record_flash(sender, message, category, **extra):
+    flashes = getattr(_recording, 'flashes', None)
+    if flashes is not None:
+        flashes.append((message, category))
+
+
+message_flashed.connect(record_flash, weak=False)
+
+
+class SingleFlight:
+    """
+    Coalesces identical in-flight calls within a worker: the first caller for a key runs the call and everyone
+    who asks for the same key meanwhile waits for and shares its result (or exception).
+    """
+
+    def __init__(self, name, replay_flashes=False):
+        self.name = name
+        self.replay_flashes = replay_flashes
+        self.stats = {'calls': 0, 'shared': 0}
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Call fn(*args, **kwargs) unless a call for key is already running, in which case wait for its result.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+                self.stats['calls'] += 1
+            else:
+                self.stats['shared'] += 1
+
+        if not leader:
+            result, flashes = call.result()
+            if flashes and has_request_context():
+                for message, category in flashes:
+                    flash(message, category)
+            return result
+
+        # Without replay, flashes still go to an outer call that is recording
+        previous = getattr(_recording, 'flashes', None)
+        flashes = [] if self.replay_flashes else previous
+        _recording.flashes = flashes
+        try:
+            result = fn(*args, **kwargs)
+            call.set_result((result, flashes if self.replay_flashes else None))
+            return result
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        finally:
+            if self.replay_flashes and previous is not None:
+                previous.extend(flashes)
+            _recording.flashes = previous
+            # Later callers start a fresh call, whatever caching fn does decides if that reaches the upstream
+            with self._lock:
+                del self._calls[key]
+
+    def get_stats(self):
+        """
+        How many calls ran and how many callers shared one instead.
+        """
+        with self._lock:
+            return dict(self.stats, in_flight=len(self._calls))
+
+
+def single_flight(key_func, replay_flashes=False):
+    """
+    Decorator that coalesces concurrent calls whose key_func(*args, **kwargs) match.
+    Set replay_flashes for functions that flash errors, so every waiting request shows them.
+    """
+    def decorator(fn):
+        group = SingleFlight(fn.__name__, replay_flashes)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            return group.do(key_func(*args, **kwargs), fn, *args, **kwargs)
+        wrapper.single_flight = group
+        return wrapper
+    return decorator
@@ -1,25 +1,59 @@
 import os
 import random
-import requests
+import http_client
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from flask import flash
 # Imports SPOTIFY_CLIENT_ID and SPOTIFY_CLIENT_SECRET
 from get_spotify_api_key import *
+from cache import PersistentCache, TTLCache, normalize_text, STALE_CACHE_TTL
+from rate_limiter import background_priority
+from single_flight import single_flight
+from track import Track, parse_playlist_items
+from track_index import track_index, seed_context
+
+# Playlist searches and tracks are cached so popular playlists aren't re-fetched for every user
+PLAYLIST_SEARCH_CACHE_TTL = int(os.getenv('PLAYLIST_SEARCH_CACHE_TTL', 60 * 60))
+PLAYLIST_CACHE_TTL = int(os.getenv('PLAYLIST_CACHE_TTL', 6 * 60 * 60))
+PLAYLIST_CACHE_CAPACITY = int(os.getenv('PLAYLIST_CACHE_CAPACITY', 2000))
+PLAYLIST_PREFETCH_WORKERS = int(os.getenv('PLAYLIST_PREFETCH_WORKERS', 4))
+
+playlist_search_cache = TTLCache(
+    capacity=PLAYLIST_CACHE_CAPACITY, ttl=PLAYLIST_SEARCH_CACHE_TTL, stale_ttl=STALE_CACHE_TTL)
+# Maps playlist id to (snapshot_id, tracks response)
+playlist_track_cache = TTLCache(
+    capacity=PLAYLIST_CACHE_CAPACITY, ttl=PLAYLIST_CACHE_TTL, stale_ttl=STALE_CACHE_TTL)
+
+# Free-text song queries resolve to the same track for a long time, recommendations for a seed change more often
+TRACK_SEARCH_INDEX_CAPACITY = int(
+    os.getenv('TRACK_SEARCH_INDEX_CAPACITY', 50000))
+TRACK_SEARCH_INDEX_TTL = int(
+    os.getenv('TRACK_SEARCH_INDEX_TTL', 30 * 24 * 60 * 60))
+SIMILAR_TRACKS_CACHE_CAPACITY = int(
+    os.getenv('SIMILAR_TRACKS_CACHE_CAPACITY', 5000))
+SIMILAR_TRACKS_CACHE_TTL = int(
+    os.getenv('SIMILAR_TRACKS_CACHE_TTL', 6 * 60 * 60))
+# Cache more recommendations than we show so repeat visits still get a varied sample
+SIMILAR_TRACKS_POOL_SIZE = int(os.getenv('SIMILAR_TRACKS_POOL_SIZE', 30))
+
+track_search_index = PersistentCache(
+    'track_search_index', capacity=TRACK_SEARCH_INDEX_CAPACITY, ttl=TRACK_SEARCH_INDEX_TTL)
+# Maps seed track id to a list of Tracks
+similar_tracks_cache = TTLCache(
+    capacity=SIMILAR_TRACKS_CACHE_CAPACITY, ttl=SIMILAR_TRACKS_CACHE_TTL, stale_ttl=STALE_CACHE_TTL)
+
+_prefetch_executor = ThreadPoolExecutor(
+    max_workers=PLAYLIST_PREFETCH_WORKERS, thread_name_prefix='playlist-prefetch')
+_prefetch_lock = threading.Lock()
+_prefetching = set()
 
 
 def get_spotify_token():
     """
-    Get spotify access token for api calls.
+    Get spotify access token for api calls, shared with the rest of the app through get_spotify_api_key.
     """
-    auth_url = 'https://accounts.spotify.com/api/token'
-    auth_response = requests.post(auth_url, {
-        'grant_type': 'client_credentials',
-        'client_id': SPOTIFY_CLIENT_ID,
-        'client_secret': SPOTIFY_CLIENT_SECRET,
-    })
-
-    auth_response_data = auth_response.json()
-    return auth_response_data['access_token']
+    return get_spotify_api_key()
 
 
 def get_spotify_genres():
@@ -28,123 +62,235 @@ def get_spotify_genres():
     """
     token = get_spotify_token()
     genre_url = 'https://api.spotify.com/v1/recommendations/available-genre-seeds'
-    response = requests.get(genre_url, headers={
+    response = http_client.get(genre_url, headers={
         'Authorization': f'Bearer {token}'
     })
     genres = response.json()['genres']
     return genres
 
 
-def get_similar(song, limit):
+# Identical searches in flight at the same time share one set of Spotify calls
+@single_flight(lambda song, pool_size: (normalize_text(song), pool_size), replay_flashes=True)
+def get_similar_pool(song, pool_size):
     """
-    Use Spotify's search method to get songs id, and then use its similar songs method to get similar songs.
+    Use Spotify's search method to get songs id, and then use its similar songs method to get up to pool_size
+    similar songs. Both steps are cached, and seeds the local track index already knows are answered without asking
+    Spotify for recommendations. Returns a list of Tracks, or None after flashing an error.
     """
-    SPOTIFY_API_KEY = get_spotify_token()
-    headers = {"Authorization": f"Bearer {SPOTIFY_API_KEY}"}
+    SPOTIFY_API_KEY = None
+    headers = None
 
 # FIRST API CALL, GRAB ID OF USER'S SONG:
 
-    params = {
-        "q": song,
-        "type": "track",
-        "limit": 1
-    }
+    query_key = normalize_text(song)
+    song_id = track_search_index.get(query_key)
+    if song_id is None:
+        SPOTIFY_API_KEY = get_spotify_token()
+        headers = {"Authorization": f"Bearer {SPOTIFY_API_KEY}"}
 
-    response = requests.get(
-        "https://api.spotify.com/v1/search", headers=headers, params=params)
-    data = response.json()
+        params = {
+            "q": song,
+            "type": "track",
+            "limit": 1
+        }
 
-    if "error" in data:
-        # Handle API error response
-        flash(
-            f"Sorry, there was an error. Please try again. Error from Spotify API: {data['error']['message']}", "error")
-        return None
+        response = http_client.get(
+            "https://api.spotify.com/v1/search", headers=headers, params=params)
+        data = response.json()
+
+        if "error" in data:
+            # Handle API error response
+            flash(
+                f"Sorry, there was an error. Please try again. Error from Spotify API: {data['error']['message']}", "error")
+            return None
 
-    song_id = data['tracks']['items'][0]['id']
+        if not data['tracks']['items']:
+            flash("Sorry, we couldn't find that song. Please try again.", "error")
+            return None
+
+        item = data['tracks']['items'][0]
+        song_id = item['id']
+        track_search_index.set(query_key, song_id)
+        track_index.add_tracks([Track.from_spotify(item)])
 
 # SECOND API CALL, FINDING SONGS SIMILAR TO USER ENTERED SONG:
 
-    params = {
-        "seed_tracks": song_id,
-        "limit": limit
-    }
+    similar_tracks = similar_tracks_cache.get(song_id)
+    if similar_tracks is None:
+        # Answer from tracks we've already seen, Spotify is only asked about seeds the index doesn't know yet
+        similar_tracks = track_index.similar(
+            f"spotify:track:{song_id}", pool_size)
+        if similar_tracks is not None:
+            similar_tracks_cache.set(song_id, similar_tracks)
+    if similar_tracks is None:
+        if headers is None:
+            SPOTIFY_API_KEY = get_spotify_token()
+            headers = {"Authorization": f"Bearer {SPOTIFY_API_KEY}"}
+
+        params = {
+            "seed_tracks": song_id,
+            "limit": pool_size
+        }
 
-    response = requests.get(
-        "https://api.spotify.com/v1/recommendations", headers=headers, params=params)
-    data = response.json()
+        response = http_client.get(
+            "https://api.spotify.com/v1/recommendations", headers=headers, params=params)
+        data = response.json()
+
+        if "error" in data:
+            # Spotify is failing or we're out of budget, an old pool is fine. The index was already asked above
+            # and didn't know enough neighbours to be trusted, so there's nothing better than showing the error
+            similar_tracks = similar_tracks_cache.get_stale(song_id)
+            if similar_tracks is None:
+                flash(
+                    f"Sorry, there was an error. Please try again. Error from Spotify API: {data['error']['message']}", "error")
+                return None
+            return similar_tracks
+
+        # Extract song details from API response
+        similar_tracks = [Track.from_spotify(item) for item in data['tracks']]
+        similar_tracks_cache.set(song_id, similar_tracks)
+        track_index.add_tracks(similar_tracks, context=seed_context(
+            f"spotify:track:{song_id}"))
+
+    return similar_tracks
 
-    if "error" in data:
+
+def get_similar(song, limit):
+    """
+    Random sample of limit songs similar to the user entered song, each caller gets its own sample from the pool.
+    """
+    similar_tracks = get_similar_pool(song, max(limit, SIMILAR_TRACKS_POOL_SIZE))
+    if similar_tracks is None:
         return None
+    return sample_similar(similar_tracks, limit)
 
+
+def sample_similar(similar_tracks, limit):
+    """
+    Random sample of limit tracks from a pool of similar tracks, keyed 1..limit for the template.
+    """
     songs_dict = {}
 
-    for i, item in enumerate(data['tracks']):
-        # Extract song details from API response
-        song_name = item['name']
-        artist_name = item['artists'][0]['name']
-        album_name = item['album']['name']
-        song_link = item['external_urls']['spotify']
-        album_cover = item['album']['images'][0]['url'] if item['album']['images'] else None
-        uri = item['uri']
-        songs_dict[i + 1] = {
-            "song_name": song_name,
-            "artist_name": artist_name,
-            "album_name": album_name,
-            "song_link": song_link,
-            "album_cover": album_cover,
-            "uri": uri
-        }
+    for i, track in enumerate(random.sample(similar_tracks, k=min(limit, len(similar_tracks)))):
+        songs_dict[i + 1] = track
 
     return songs_dict
 
 
-def get_playlist_from_spotify(query_words, genre):
+def get_similar_cache_stats():
     """
-    Fetch playlist from Spotify based on query words and genre, randomly selects one of the first five to pop up.
+    Hit rates for the search index and recommendation cache behind get_similar.
     """
+    return {
+        'track_search_index': track_search_index.get_stats(),
+        'similar_tracks': similar_tracks_cache.get_stats(),
+        'track_index': track_index.get_stats(),
+    }
+
+
+def search_spotify_playlists(query, limit=5):
+    """
+    Search Spotify for playlists matching the query, returns the raw search response.
+    """
+    cache_key = (normalize_text(query), limit)
+    data = playlist_search_cache.get(cache_key)
+    if data is not None:
+        return data
+
     SPOTIFY_API_KEY = get_spotify_token()
     headers = {"Authorization": f"Bearer {SPOTIFY_API_KEY}"}
 
-    final_query = f"{genre} {' '.join(query_words)}"
-
     params = {
-        "q": final_query,
+        "q": query,
         "type": "playlist",
-        "limit": 5
+        "limit": limit
     }
 
-    response = requests.get(
+    response = http_client.get(
         "https://api.spotify.com/v1/search", headers=headers, params=params)
     data = response.json()
 
-    if "error" in data:
-        flash(
-            f"Sorry, there was an error. Please try again. Error from Spotify API: {data['error']['message']}", "error")
-        return None
+    if "error" not in data:
+        playlist_search_cache.set(cache_key, data)
+    else:
+        # An expired search result beats an error page while Spotify is failing or we're out of budget
+        data = playlist_search_cache.get_stale(cache_key, data)
+    return data
 
-    playlists = data['playlists']['items']
-    if not playlists:
-        flash(f"Sorry, there was an error. Please try again. Error from Spotify API: No playlist found that matches critera", "error")
-        return None
 
-    selected_playlist = random.choice(playlists)
-    playlist_id = selected_playlist['id']
+def get_spotify_playlist_tracks(playlist_id, limit=20):
+    """
+    Get the first tracks of a Spotify playlist, returns the raw response.
+    """
+    SPOTIFY_API_KEY = get_spotify_token()
+    headers = {"Authorization": f"Bearer {SPOTIFY_API_KEY}"}
 
-    # Get tracks from the playlist
     playlist_url = f"https://api.spotify.com/v1/playlists/{playlist_id}/tracks"
     params = {
-        "limit": 20
+        "limit": limit
     }
-    response = requests.get(playlist_url, headers=headers, params=params)
-    playlist_data = response.json()
+    response = http_client.get(playlist_url, headers=headers, params=params)
+    return response.json()
+
 
+def get_playlist_tracks(playlist_id, snapshot_id=None):
+    """
+    Get a playlist's tracks from the cache, re-fetching them if the playlist's snapshot_id has changed.
+    """
+    cached = playlist_track_cache.get(playlist_id)
+    if cached is not None and (snapshot_id is None or cached[0] == snapshot_id):
+        return cached[1]
+
+    playlist_data = get_spotify_playlist_tracks(playlist_id)
     if "error" in playlist_data:
-        flash(
-            f"Sorry, there was an error. Please try again. Error from Spotify API: {playlist_data['error']['message']}", "error")
-        return None
+        stale = playlist_track_cache.get_stale(playlist_id)
+        return playlist_data if stale is None else stale[1]
 
-    tracks = playlist_data['items']
-    return tracks
+    # Parse once here so cache hits hand out the same Track objects
+    playlist_data = {'items': parse_playlist_items(playlist_data['items'])}
+    playlist_track_cache.set(playlist_id, (snapshot_id, playlist_data))
+    track_index.add_tracks(
+        playlist_data['items'], context=f"playlist:{playlist_id}")
+    return playlist_data
+
+
+def prefetch_playlist(playlist_id, snapshot_id):
+    """
+    Background task that warms the track cache for one playlist.
+    """
+    try:
+        with background_priority():
+            get_playlist_tracks(playlist_id, snapshot_id)
+    except Exception as e:
+        print(f"Error prefetching playlist {playlist_id}: {e}")
+    finally:
+        with _prefetch_lock:
+            _prefetching.discard(playlist_id)
+
+
+def prefetch_playlists(playlists):
+    """
+    Fetch tracks for search hits we didn't pick in the background, so the next similar request is served from memory.
+    """
+    for playlist in playlists:
+        cached = playlist_track_cache.get(playlist['id'])
+        if cached is not None and cached[0] == playlist.get('snapshot_id'):
+            continue
+        with _prefetch_lock:
+            if playlist['id'] in _prefetching:
+                continue
+            _prefetching.add(playlist['id'])
+        _prefetch_executor.submit(
+            prefetch_playlist, playlist['id'], playlist.get('snapshot_id'))
+
+
+def build_search_query(query_words, genre):
+    """
+    Spotify playlist search query from the genre and GPT's query words, which may be one string or a list of words.
+    """
+    if not isinstance(query_words, str):
+        query_words = ' '.join(query_words)
+    return normalize_text(f"{genre} {query_words}")
 
 
 def get_songs_from_playlist(genre, tracks):
@@ -156,29 +302,7 @@ def get_songs_from_playlist(genre, tracks):
         print("Flash message set: No tracks found or there was an error retrieving the playlist.")
         return {}
     songs_dict = {}
-    for i, track in enumerate(tracks):
-        song_name = track['track']['name']
-        artist_name = track['track']['artists'][0]['name']
-        album_name = track['track']['album']['name']
-        # Handle the case where 'external_urls' might not have the 'spotify' key
-        song_link = track['track'].get('external_urls', {}).get(
-            'spotify', 'URL not available')
-        uri = track['track']['uri']
-        # Handle the case where album images might be empty or missing
-        album_cover = None
-        if 'images' in track['track']['album'] and len(track['track']['album']['images']) > 0:
-            album_cover = track['track']['album']['images'][0].get('url', None)
-
-        popularity = track['track']['popularity']
-
-        songs_dict[i + 1] = {
-            "song_name": song_name,
-            "artist_name": artist_name,
-            "album_name": album_name,
-            "song_link": song_link,
-            "album_cover": album_cover,
-            "popularity": popularity,
-            "uri": uri,
-        }
+    for i, track in enumerate(parse_playlist_items(tracks)):
+        songs_dict[i + 1] = track
 
     return songs_dict
@@ -0,0 +1,53 @@
+import sys
+from dataclasses import dataclass, asdict
+
+
+@dataclass(frozen=True, slots=True)
+class Track:
+    """
+    A single Spotify track with just the fields our pages use, shared between caches and templates without copying.
+    """
+    song_name: str
+    artist_name: str
+    album_name: str
+    song_link: str
+    album_cover: str
+    popularity: int
+    uri: str
+
+    def __getitem__(self, key):
+        # Lets existing code and templates keep using song['song_name']
+        return getattr(self, key)
+
+    def to_dict(self):
+        return asdict(self)
+
+    @classmethod
+    def from_spotify(cls, item):
+        """
+        Build a Track from a Spotify track object, interning repeated artist and album names.
+        """
+        album = item.get('album') or {}
+        images = album.get('images') or []
+        artists = item.get('artists') or [{}]
+        return cls(
+            song_name=item['name'],
+            artist_name=sys.intern(artists[0].get('name') or ''),
+            album_name=sys.intern(album.get('name') or ''),
+            # Handle the case where 'external_urls' might not have the 'spotify' key
+            song_link=(item.get('external_urls') or {}).get(
+                'spotify', 'URL not available'),
+            # Handle the case where album images might be empty or missing
+            album_cover=images[0].get('url') if images else None,
+            popularity=item.get('popularity', 0),
+            uri=item['uri'],
+        )
+
+
+def parse_playlist_items(items):
+    """
+    Turn the items of a Spotify playlist tracks response into Tracks, skipping removed or local tracks.
+    """
+    return [item if isinstance(item, Track) else Track.from_spotify(item['track'])
+            for item in items
+            if isinstance(item, Track) or item.get('track')]
@@ -0,0 +1,250 @@
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+from dotenv import load_dotenv
+from cache import CACHE_DB_PATH, get_hit_rate, normalize_text
+from db import get_db_connection
+from track import Track
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Every track we fetch is kept here so "songs like X" can usually be answered without calling Spotify
+TRACK_INDEX_CAPACITY = int(os.getenv('TRACK_INDEX_CAPACITY', 20000))
+# A seed needs this many neighbours scoring at least TRACK_INDEX_MIN_SCORE before we trust the local answer
+TRACK_INDEX_MIN_NEIGHBOURS = int(os.getenv('TRACK_INDEX_MIN_NEIGHBOURS', 10))
+TRACK_INDEX_MIN_SCORE = float(os.getenv('TRACK_INDEX_MIN_SCORE', 0.3))
+# One playlist in common says little, a neighbour must share this many contexts with the seed unless Spotify
+# recommended it for the seed
+TRACK_INDEX_MIN_SHARED_CONTEXTS = int(
+    os.getenv('TRACK_INDEX_MIN_SHARED_CONTEXTS', 2))
+# Sharing an artist counts for less than sharing a playlist, otherwise every answer is one artist's discography
+ARTIST_FEATURE_WEIGHT = 0.5
+
+
+def seed_context(uri):
+    """
+    Context recorded on tracks Spotify recommended for uri.
+    """
+    return f"seed:{uri}"
+
+
+class TrackIndex:
+    """
+    Local catalog of tracks, each with a sparse vector of the playlists, recommendation seeds, users and artist it
+    was seen with. Tracks that keep turning up together end up close by cosine similarity.
+    """
+
+    def __init__(self, capacity=None, db_path=None):
+        self.capacity = capacity or TRACK_INDEX_CAPACITY
+        self.db_path = db_path or CACHE_DB_PATH
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._lock = threading.RLock()
+        self._table_created = False
+        self._loaded = False
+
+    def _get_connection(self):
+        """
+        This thread's connection to the catalog database, creating the table on first use.
+        """
+        conn = get_db_connection(self.db_path)
+        if not self._table_created:
+            conn.execute('''CREATE TABLE IF NOT EXISTS track_index (
+                                uri TEXT PRIMARY KEY,
+                                track TEXT NOT NULL,
+                                features TEXT NOT NULL,
+                                updated_at REAL NOT NULL
+                            )''')
+            conn.commit()
+            self._table_created = True
+        return conn
+
+    def _reset(self):
+        self._tracks = {}
+        self._features = {}
+        self._norms = {}
+        self._updated = {}
+        # Maps each context to the uris seen in it, only tracks sharing a context with the seed are ever scored
+        self._postings = {}
+
+    def _load(self):
+        """
+        Read the catalog from SQLite the first time the index is used.
+        """
+        if self._loaded:
+            return
+        self._reset()
+        rows = self._get_connection().execute('''SELECT track, features, updated_at FROM track_index
+                                                 ORDER BY updated_at DESC LIMIT ?''', (self.capacity,)).fetchall()
+        for track, features, updated_at in rows:
+            # Rows from the old hashed layout have numeric keys that can't be mapped back to a context
+            features = {name: weight for name, weight in json.loads(features).items()
+                        if not name.isdigit()}
+            self._put(Track(**json.loads(track)), features, updated_at)
+        self._loaded = True
+
+    def _put(self, track, features, updated_at):
+        """
+        Store a track and its features, evicting old tracks first if it is new and the catalog is full.
+        """
+        if track.uri in self._tracks:
+            self._unlink(track.uri)
+        elif len(self._tracks) >= self.capacity:
+            self._evict()
+
+        self._tracks[track.uri] = track
+        self._features[track.uri] = features
+        self._updated[track.uri] = updated_at
+        self._norms[track.uri] = math.sqrt(sum(weight * weight for weight in features.values()))
+        for name in features:
+            self._postings.setdefault(name, set()).add(track.uri)
+
+    def _unlink(self, uri):
+        for name in self._features[uri]:
+            uris = self._postings[name]
+            uris.discard(uri)
+            if not uris:
+                del self._postings[name]
+
+    def _remove(self, uri):
+        self._unlink(uri)
+        del self._tracks[uri]
+        del self._features[uri]
+        del self._updated[uri]
+        del self._norms[uri]
+
+    def _evict(self):
+        """
+        Drop the least recently updated 5% of the catalog.
+        """
+        oldest = sorted(self._updated, key=self._updated.__getitem__)[
+            :max(1, self.capacity // 20)]
+        for uri in oldest:
+            self._remove(uri)
+        self.stats['evictions'] += len(oldest)
+        try:
+            self._get_connection().executemany(
+                'DELETE FROM track_index WHERE uri=?', [(uri,) for uri in oldest])
+        except sqlite3.Error as e:
+            print(f"Error evicting tracks from the track index: {e}")
+
+    def add_tracks(self, tracks, context=None):
+        """
+        Add tracks to the catalog, recording that each was seen in context (a playlist, seed or user's saves).
+        """
+        now = time.time()
+        changed = []
+        with self._lock:
+            self._load()
+            for track in tracks:
+                known = track.uri in self._tracks
+                features = dict(self._features[track.uri]) if known else {}
+                contexts = [(f"artist:{normalize_text(track.artist_name)}", ARTIST_FEATURE_WEIGHT)]
+                if context:
+                    contexts.append((context, 1.0))
+                new_features = False
+                for name, weight in contexts:
+                    if features.get(name, 0) < weight:
+                        features[name] = weight
+                        new_features = True
+                if known and not new_features:
+                    continue
+                # Keep the first copy we saw, saved songs don't carry popularity or album covers
+                if known:
+                    track = self._tracks[track.uri]
+                self._put(track, features, now)
+                changed.append((track.uri, json.dumps(track.to_dict()),
+                                json.dumps(features), now))
+
+            if not changed:
+                return
+            try:
+                conn = self._get_connection()
+                conn.executemany('''INSERT OR REPLACE INTO track_index (uri, track, features, updated_at)
+                                    VALUES (?, ?, ?, ?)''', changed)
+                conn.commit()
+            except sqlite3.Error as e:
+                print(f"Error saving tracks to the track index: {e}")
+
+    def _score(self, uri):
+        """
+        Cosine similarity of every track sharing a context with uri, best first with more popular tracks first on ties.
+        """
+        query = dict(self._features.get(uri, {}))
+        # Tracks Spotify recommended for this seed are its neighbours even before the seed itself is cataloged
+        query[seed_context(uri)] = 1.0
+        query_norm = math.sqrt(sum(weight * weight for weight in query.values()))
+
+        dots = {}
+        shared = {}
+        for name, weight in query.items():
+            for other in self._postings.get(name, ()):
+                dots[other] = dots.get(other, 0) + weight * self._features[other][name]
+                shared[other] = shared.get(other, 0) + 1
+        dots.pop(uri, None)
+
+        seed = seed_context(uri)
+        scored = []
+        for other, dot in dots.items():
+            if shared[other] < TRACK_INDEX_MIN_SHARED_CONTEXTS and seed not in self._features[other]:
+                continue
+            score = dot / (self._norms[other] * query_norm)
+            if score >= TRACK_INDEX_MIN_SCORE:
+                scored.append((-score, -(self._tracks[other].popularity or 0), other))
+        scored.sort()
+        return [other for _, _, other in scored]
+
+    def similar(self, uri, limit, min_neighbours=None):
+        """
+        Up to limit cataloged tracks most like the track uri, best first, or None if the seed has fewer than
+        min_neighbours (TRACK_INDEX_MIN_NEIGHBOURS by default) to answer locally.
+        """
+        min_neighbours = TRACK_INDEX_MIN_NEIGHBOURS if min_neighbours is None else min_neighbours
+        with self._lock:
+            self._load()
+            neighbours = self._score(uri)
+            if not neighbours or len(neighbours) < min_neighbours:
+                self.stats['misses'] += 1
+                return None
+
+            # Other versions of the seed (remasters, live cuts) aren't useful recommendations
+            seed = self._tracks.get(uri)
+            seed_key = seed and (normalize_text(seed.artist_name), normalize_text(seed.song_name))
+            tracks = []
+            for other in neighbours:
+                track = self._tracks[other]
+                if seed_key and (normalize_text(track.artist_name), normalize_text(track.song_name)) == seed_key:
+                    continue
+                tracks.append(track)
+                if len(tracks) == limit:
+                    break
+            self.stats['hits'] += 1
+            return tracks
+
+    def clear(self):
+        """
+        Remove every track from the catalog.
+        """
+        with self._lock:
+            conn = self._get_connection()
+            conn.execute('DELETE FROM track_index')
+            conn.commit()
+            self._reset()
+            self._loaded = True
+
+    def __len__(self):
+        with self._lock:
+            self._load()
+            return len(self._tracks)
+
+    def get_stats(self):
+        """
+        Hit, miss and eviction counters along with the catalog size.
+        """
+        return dict(self.stats, size=len(self), capacity=self.capacity, hit_rate=get_hit_rate(self.stats))
+
+
+track_index = TrackIndex()
@@ -1,11 +1,46 @@
+import json
+import os
+import tempfile
+import threading
+import time
 import unittest
+from contextlib import contextmanager
 from unittest.mock import patch, MagicMock
+from flask import Flask, flash, get_flashed_messages
+from urllib3 import HTTPResponse
+from urllib3.exceptions import MaxRetryError
+
+# Keep the tests away from the real users.db and cache.db
+if 'DATABASE_PATH' not in os.environ:
+    os.environ['DATABASE_PATH'] = os.path.join(
+        tempfile.mkdtemp(), 'test_users.db')
+if 'CACHE_DB_PATH' not in os.environ:
+    os.environ['CACHE_DB_PATH'] = os.path.join(
+        tempfile.mkdtemp(), 'test_cache.db')
+
+import db
+import genre_cache
+from cache import PersistentCache
 from get_spotify_api_key import *
+from http_client import get_session, ApiRetry
 from match_the_day import *
 from match_the_mood import *
 from match_the_song import *
+from migrations import migrate, LATEST_VERSION
+from playlist_feature import *
+from precompute import plan_precompute
+from precomputed_store import write_precomputed_store, load_precomputed_store, get_precomputed_pool
+import recommender
+from rate_limiter import TokenBucket, background_priority
+from recommender import CandidatePool, candidate_pool_cache, get_candidate_pool
+from request_log import log_request, get_request_key
+from result_cache import store_result, load_result
 from save_songs import *
 from songs import *
+from session_store import ServerSideSessionInterface, MemorySessionBackend, SQLiteSessionBackend
+from single_flight import single_flight
+from track import Track
+from track_index import TrackIndex, track_index
 from user_accounts import *
 
 
@@ -13,16 +48,44 @@ class UnitTests(unittest.TestCase):
     """
     Unit testing file, ensures main functionality works and uses mocks to imitate user input.
     """
-    @patch('get_spotify_api_key.requests.post')
+    @classmethod
+    def setUpClass(cls):
+        migrate()
+        cls.test_app = Flask(__name__)
+        cls.test_app.secret_key = "test"
+
+    @contextmanager
+    def request_context(self, **session_values):
+        """
+        A request context on the shared test app with session_values already in the session.
+        """
+        with self.test_app.test_request_context():
+            session.update(session_values)
+            yield
+
+    @patch('http_client.post')
     def test_get_spotify_api_key(self, mock_post):
         mock_response = MagicMock()
         mock_response.json.return_value = {"access_token": "test_token"}
         mock_post.return_value = mock_response
 
+        clear_spotify_api_key()
         token = get_spotify_api_key()
         self.assertEqual(token, "test_token")
 
-    @patch('match_the_day.requests.get')
+    @patch('http_client.post')
+    def test_get_spotify_api_key_is_cached(self, mock_post):
+        mock_response = MagicMock()
+        mock_response.json.return_value = {
+            "access_token": "test_token", "expires_in": 3600}
+        mock_post.return_value = mock_response
+
+        clear_spotify_api_key()
+        self.assertEqual(get_spotify_api_key(), "test_token")
+        self.assertEqual(get_spotify_token(), "test_token")
+        self.assertEqual(mock_post.call_count, 1)
+
+    @patch('http_client.get')
     def test_weather_forecast(self, mock_get):
         mock_response = MagicMock()
         mock_response.status_code = 200
@@ -32,13 +95,61 @@ class UnitTests(unittest.TestCase):
         }
         mock_get.return_value = mock_response
 
+        weather_cache.clear()
+        city_aliases.clear()
         result = weather_forecast("New York", "fake_api_key")
         self.assertEqual(result, ((75, "Sunny"), "New York"))
 
+    @patch('http_client.get')
+    def test_weather_forecast_is_cached_by_canonical_city(self, mock_get):
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = {
+            "location": {"name": "New York", "region": "New York"},
+            "current": {"temp_f": 75, "condition": {"text": "Sunny"}}
+        }
+        mock_get.return_value = mock_response
+
+        weather_cache.clear()
+        city_aliases.clear()
+        self.assertEqual(weather_forecast("NYC", "fake_api_key"),
+                         ((75, "Sunny"), "New York"))
+        self.assertEqual(weather_forecast(" nyc ", "fake_api_key"),
+                         ((75, "Sunny"), "New York"))
+        self.assertEqual(mock_get.call_count, 1)
+        # WeatherAPI's bare city name isn't an alias, it may resolve to another region when typed on its own
+        self.assertEqual(weather_forecast("new york", "fake_api_key"),
+                         ((75, "Sunny"), "New York"))
+        self.assertEqual(mock_get.call_count, 2)
+
+    def test_http_sessions_are_pooled_per_host(self):
+        spotify = get_session("https://api.spotify.com/v1/search")
+        self.assertIs(spotify, get_session("https://api.spotify.com/v1/me"))
+        self.assertIsNot(spotify, get_session(
+            "http://api.weatherapi.com/v1/current.json"))
+
+    def test_api_retry_only_retries_post_on_429(self):
+        retry = ApiRetry(total=3, status_forcelist=(429, 503),
+                         allowed_methods={'GET', 'POST'})
+        self.assertTrue(retry.is_retry('GET', 503))
+        self.assertTrue(retry.is_retry('POST', 429))
+        self.assertFalse(retry.is_retry('POST', 503))
+
+    def test_api_retry_hands_back_long_retry_after(self):
+        retry = ApiRetry(total=3, status_forcelist=(429,))
+        short = HTTPResponse(status=429, headers={'Retry-After': '1'})
+        self.assertEqual(retry.increment('GET', '/', response=short).total, 2)
+        long = HTTPResponse(status=429, headers={'Retry-After': '3600'})
+        with self.assertRaises(MaxRetryError):
+            retry.increment('GET', '/', response=long)
+
+    @patch('match_the_day.get_spotify_token', MagicMock(return_value="token"))
+    @patch('match_the_day.search_spotify_playlists')
     @patch('match_the_day.weather_forecast')
     @patch('match_the_day.gpt_query_words')
     @patch('match_the_day.recommend_songs')
-    def test_get_songs_from_activity(self, mock_recommend_songs, mock_gpt_query_words, mock_weather_forecast):
+    def test_get_songs_from_activity(self, mock_recommend_songs, mock_gpt_query_words, mock_weather_forecast,
+                                     mock_search):
         mock_weather_forecast.return_value = ((75, "Sunny"), "New York")
         mock_gpt_query_words.return_value = "sunny, jogging"
         mock_recommend_songs.return_value = {"song1": "details"}
@@ -47,6 +158,31 @@ class UnitTests(unittest.TestCase):
             "New York", "jogging", "pop")
         self.assertEqual(result, {"song1": "details"})
         self.assertEqual(weather_stats, (75, "Sunny"))
+        # The genre-only search is just for when GPT fails
+        mock_search.assert_not_called()
+
+    @patch('match_the_day.get_spotify_token', MagicMock(return_value="token"))
+    @patch('match_the_day.get_playlist_tracks')
+    @patch('match_the_day.search_spotify_playlists')
+    @patch('match_the_day.weather_forecast')
+    @patch('match_the_day.gpt_query_words')
+    @patch('match_the_day.recommend_songs')
+    def test_activity_pipeline_falls_back_to_genre_search(self, mock_recommend_songs, mock_gpt_query_words,
+                                                          mock_weather_forecast, mock_search, mock_tracks):
+        mock_weather_forecast.return_value = ((75, "Sunny"), "New York")
+        mock_gpt_query_words.side_effect = Exception("GPT is down")
+        mock_search.return_value = {"playlists": {"items": [None, {"id": "p1"}]}}
+        mock_tracks.return_value = {"items": ["track"]}
+        mock_recommend_songs.return_value = {"song1": "details"}
+
+        result = run_activity_pipeline("New York", "jogging", "pop")
+        self.assertTrue(result.used_genre_fallback)
+        self.assertEqual(result.songs, {"song1": "details"})
+        self.assertEqual(result.weather_stats, (75, "Sunny"))
+        mock_search.assert_called_once_with("pop")
+        mock_tracks.assert_called_once_with("p1", None)
+        mock_recommend_songs.assert_called_once_with('', "pop", ["track"])
+        self.assertIn('total', result.timings)
 
     @patch('match_the_mood.gpt_query_words_mood')
     @patch('match_the_mood.recommend_songs')
@@ -58,6 +194,193 @@ class UnitTests(unittest.TestCase):
         self.assertEqual(result, {"song1": "details"})
         self.assertEqual(mood, "happy")
 
+    @patch('recommender.RECOMMEND_JITTER', 0)
+    @patch('recommender.get_playlist_tracks')
+    @patch('recommender.search_spotify_playlists')
+    def test_recommend_songs_ranks_a_deduplicated_pool(self, mock_search, mock_tracks):
+        def track(name, artist, uri, popularity=50):
+            return {"track": {"name": name, "artists": [{"name": artist}], "uri": uri, "popularity": popularity}}
+        mock_search.return_value = {"playlists": {"items": [
+            {"id": "p1", "name": "Pop Hits"}, None, {"id": "p2", "name": "Chill"}]}}
+        mock_tracks.side_effect = lambda playlist_id, snapshot_id: {"items": {
+            "p1": [track("Shared", "a", "spotify:track:1"), track("Solo", "b", "spotify:track:2", 90),
+                   track("Second", "b", "spotify:track:3", 90)],
+            "p2": [track("Shared (Remastered 2011)", "A", "spotify:track:4"), track("Other", "c", "spotify:track:5")],
+        }[playlist_id]}
+        candidate_pool_cache.clear()
+
+        pool = get_candidate_pool("sunny, happy", "pop")
+        self.assertEqual(len(pool.tracks), 4)
+        self.assertEqual(mock_search.call_args[0][0], "pop sunny, happy")
+        for numpy_module in (recommender.np, None):
+            with patch('recommender.np', numpy_module):
+                songs = recommend_songs("sunny, happy", "pop")
+            # Found in both playlists first, then artist b only once before the other artists
+            self.assertEqual([song.uri for song in songs.values()],
+                             ["spotify:track:1", "spotify:track:2", "spotify:track:5", "spotify:track:3"])
+        self.assertEqual(mock_search.call_count, 1)
+        self.assertEqual(mock_tracks.call_count, 2)
+
+    @patch('match_the_mood.gpt_query_words_mood', MagicMock(side_effect=Exception("GPT should not be called")))
+    def test_precomputed_pools_serve_popular_requests(self):
+        conn = db.get_db_connection()
+        conn.execute('DELETE FROM request_log')
+        conn.commit()
+        for _ in range(3):
+            log_request('mood', ["happy", "pop"])
+        log_request('mood', ["sad", "rock"])
+        plan = plan_precompute(3, ["pop", "jazz"], seed_moods=1)
+        self.assertEqual(plan, [('mood', ["happy", "pop"]), ('mood', ["sad", "rock"]),
+                                ('mood', ["happy", "jazz"])])
+
+        pool = CandidatePool(tracks=(Track("song1", "artist1", "album1", "link", None, 10, "spotify:track:1"),),
+                             popularity=(0.1,), consensus=(1.0,), genre_match=(1.0,))
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'precomputed.bin')
+            write_precomputed_store(
+                {get_request_key('mood', ["happy", "pop"]): pool}, path)
+            self.assertEqual(len(load_precomputed_store(path)), 1)
+            try:
+                songs, mood = get_songs_from_mood(" Happy ", "Pop")
+                self.assertEqual(songs[1].uri, "spotify:track:1")
+                self.assertEqual(mood, " Happy ")
+                self.assertEqual(get_precomputed_pool(
+                    get_request_key('mood', ["happy", "pop"])), pool)
+            finally:
+                load_precomputed_store(os.path.join(tmp, 'missing.bin'))
+
+    def test_token_bucket_reserves_budget_for_interactive_calls(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            bucket = TokenBucket("test", rate=0.001, burst=4,
+                                 db_path=os.path.join(tmp, "limits.db"))
+            with background_priority():
+                # A quarter of the burst is held back from background work
+                for _ in range(3):
+                    self.assertTrue(bucket.acquire(max_wait=0))
+                self.assertFalse(bucket.acquire(max_wait=0))
+            self.assertTrue(bucket.acquire(max_wait=0))
+            self.assertFalse(bucket.acquire(max_wait=0))
+
+            # Another process's bucket shares the same budget
+            other = TokenBucket("test", rate=1000, burst=4,
+                                db_path=os.path.join(tmp, "limits.db"))
+            other.backoff(60)
+            self.assertFalse(other.acquire(max_wait=0))
+            stats = bucket.get_stats()
+            self.assertEqual((stats["acquired"], stats["background_acquired"], stats["rejected"]), (4, 3, 2))
+            db.close_db_connection(os.path.join(tmp, "limits.db"))
+
+    @patch('songs.get_spotify_token', MagicMock(return_value="token"))
+    @patch('rate_limiter.acquire', MagicMock(return_value=False))
+    def test_exhausted_budget_degrades_to_stale_cache(self):
+        playlist_search_cache.clear()
+        stale = {"playlists": {"items": [{"id": "p1"}]}}
+        playlist_search_cache.set(("rainy day", 5), stale, ttl=-1)
+        self.assertIs(search_spotify_playlists("Rainy  Day"), stale)
+        self.assertEqual(search_spotify_playlists("sunny day")["error"]["status"], 429)
+
+    @patch('songs.get_spotify_token', MagicMock(return_value="token"))
+    @patch('rate_limiter.acquire', MagicMock(return_value=False))
+    def test_exhausted_budget_shows_error_instead_of_weak_neighbours(self):
+        track_search_index.clear()
+        similar_tracks_cache.clear()
+        track_index.clear()
+        track_search_index.set("lonely song", "seed")
+        track_index.add_tracks([Track("lonely song", "artist", "album", "link", None, 10, "spotify:track:seed"),
+                                Track("other", "artist2", "album", "link", None, 10, "spotify:track:other")],
+                               context="playlist:p1")
+
+        with self.request_context():
+            self.assertIsNone(get_similar("Lonely Song", 5))
+            self.assertEqual(len(get_flashed_messages()), 1)
+
+    def test_single_flight_shares_one_call_and_its_flashes(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        @single_flight(lambda query: query.lower(), replay_flashes=True)
+        def slow_search(query):
+            calls.append(query)
+            started.set()
+            release.wait(5)
+            flash("Spotify is slow", "error")
+            return {"query": query}
+
+        results = {}
+
+        def search(name, query):
+            with self.request_context():
+                result = slow_search(query)
+                results[name] = (result, get_flashed_messages(with_categories=True))
+
+        leader = threading.Thread(target=search, args=("leader", "Jazz"))
+        leader.start()
+        started.wait(5)
+        follower = threading.Thread(target=search, args=("follower", "jazz"))
+        follower.start()
+        while slow_search.single_flight.get_stats()["shared"] == 0:
+            time.sleep(0.01)
+        release.set()
+        leader.join(5)
+        follower.join(5)
+
+        self.assertEqual(calls, ["Jazz"])
+        self.assertIs(results["leader"][0], results["follower"][0])
+        self.assertEqual(results["follower"][1], [("error", "Spotify is slow")])
+        self.assertEqual(slow_search.single_flight.get_stats()["in_flight"], 0)
+
+    def test_persistent_cache_evicts_least_recently_used(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "cache.db")
+            cache = PersistentCache("test", capacity=2, ttl=1, db_path=path)
+            cache.set("a", ["one"])
+            cache.set("b", ["two"])
+            time.sleep(0.15)
+            self.assertEqual(cache.get("a"), ["one"])
+            cache.set("c", ["three"])
+
+            self.assertIsNone(cache.get("b"))
+            self.assertEqual(cache.get("c"), ["three"])
+            stats = cache.get_stats()
+            self.assertEqual(stats["evictions"], 1)
+            self.assertEqual(stats["size"], 2)
+
+            reopened = PersistentCache("test", capacity=2, db_path=path)
+            self.assertEqual(reopened.get("a"), ["one"])
+            db.close_db_connection(path)
+
+    def test_persistent_cache_hit_skips_recent_last_used_write(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "cache.db")
+            cache = PersistentCache("test", db_path=path)
+            cache.set("a", ["one"])
+            conn = db.get_db_connection(path)
+            last_used = conn.execute('SELECT last_used FROM cache_entries').fetchone()[0]
+
+            self.assertEqual(cache.get("a"), ["one"])
+            self.assertEqual(conn.execute('SELECT last_used FROM cache_entries').fetchone()[0], last_used)
+            db.close_db_connection(path)
+
+    @patch('http_client.get_openai_client')
+    def test_gpt_query_words_mood_is_cached_on_normalized_mood(self, mock_get_openai_client):
+        completion = MagicMock()
+        completion.choices[0].message.content = "happy, upbeat"
+        mock_get_openai_client.return_value.chat.completions.create.return_value = completion
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = PersistentCache(
+                "gpt_query_words", db_path=os.path.join(tmp, "cache.db"))
+            with patch('match_the_mood.gpt_query_cache', cache):
+                self.assertEqual(gpt_query_words_mood(
+                    "Happy", "key"), "happy, upbeat")
+                self.assertEqual(gpt_query_words_mood(
+                    "  happy ", "key"), "happy, upbeat")
+            db.close_db_connection(cache.db_path)
+
+        self.assertEqual(
+            mock_get_openai_client.return_value.chat.completions.create.call_count, 1)
+
     @patch('match_the_song.get_similar')
     def test_get_similar_songs(self, mock_get_similar):
         mock_get_similar.return_value = {"song1": "details"}
@@ -65,17 +388,430 @@ class UnitTests(unittest.TestCase):
         result = get_similar_songs("test_song")
         self.assertEqual(result, {"song1": "details"})
 
-    @patch('songs.get_playlist_from_spotify')
-    def test_get_songs_from_playlist(self, mock_get_playlist_from_spotify):
-        mock_get_playlist_from_spotify.return_value = [
+    def test_get_songs_from_playlist(self):
+        tracks = [
             {"track": {"name": "song1", "artists": [{"name": "artist1"}], "album": {"name": "album1", "images": [
                 {"url": "link"}]}, "external_urls": {"spotify": "link"}, "popularity": 50, "uri": 1}}
         ]
 
-        result = get_songs_from_playlist(
-            "pop", mock_get_playlist_from_spotify.return_value)
+        result = get_songs_from_playlist("pop", tracks)
         self.assertEqual(result[1]["song_name"], "song1")
 
+    @patch('genre_cache.get_spotify_genres')
+    def test_genre_cache_serves_snapshot_without_fetching(self, mock_get_spotify_genres):
+        with tempfile.TemporaryDirectory() as tmp:
+            snapshot_path = os.path.join(tmp, "genres.json")
+            with open(snapshot_path, "w") as f:
+                json.dump({"genres": ["pop", "rock"],
+                          "fetched_at": time.time()}, f)
+
+            with patch.object(genre_cache, "GENRE_SNAPSHOT_PATH", snapshot_path), \
+                    patch.object(genre_cache, "_genres", None):
+                self.assertEqual(genre_cache.get_genres(), ["pop", "rock"])
+                self.assertEqual(genre_cache.get_genres(), ["pop", "rock"])
+
+        mock_get_spotify_genres.assert_not_called()
+
+    @patch('genre_cache.get_spotify_genres')
+    def test_genre_cache_miss_fetches_and_saves_snapshot(self, mock_get_spotify_genres):
+        mock_get_spotify_genres.return_value = ["jazz"]
+        with tempfile.TemporaryDirectory() as tmp:
+            snapshot_path = os.path.join(tmp, "genres.json")
+
+            with patch.object(genre_cache, "GENRE_SNAPSHOT_PATH", snapshot_path), \
+                    patch.object(genre_cache, "_genres", None):
+                self.assertEqual(genre_cache.get_genres(), ["jazz"])
+                self.assertEqual(genre_cache.get_genres(), ["jazz"])
+
+            with open(snapshot_path) as f:
+                self.assertEqual(json.load(f)["genres"], ["jazz"])
+        self.assertEqual(mock_get_spotify_genres.call_count, 1)
+
+    @patch('songs.get_spotify_token', MagicMock(return_value="token"))
+    @patch('songs.get_spotify_playlist_tracks')
+    @patch('http_client.get')
+    def test_playlist_tracks_are_cached_and_prefetched(self, mock_get, mock_tracks):
+        mock_get.return_value.json.return_value = {"playlists": {"items": [
+            {"id": "p1", "snapshot_id": "a"}, {"id": "p2", "snapshot_id": "b"}]}}
+        mock_tracks.side_effect = lambda playlist_id: {"items": [
+            {"track": {"name": playlist_id, "uri": "spotify:track:" + playlist_id}}]}
+        playlist_search_cache.clear()
+        playlist_track_cache.clear()
+
+        with patch('songs.random.choice', side_effect=lambda items: items[0]):
+            first = get_genre_fallback_playlist(search_spotify_playlists("pop"))
+            self.assertEqual(first[0].uri, "spotify:track:p1")
+            self.assertIs(get_genre_fallback_playlist(
+                search_spotify_playlists("pop")), first)
+
+        deadline = time.time() + 5
+        while playlist_track_cache.get("p2") is None and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(get_playlist_tracks("p2", "b")[
+                         "items"][0].song_name, "p2")
+
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(mock_tracks.call_count, 2)
+
+        # A new snapshot_id means the playlist changed and must be re-fetched
+        get_playlist_tracks("p1", "changed")
+        self.assertEqual(mock_tracks.call_count, 3)
+
+    @patch('songs.get_spotify_token', MagicMock(return_value="token"))
+    @patch('http_client.get')
+    def test_get_similar_is_cached(self, mock_get):
+        search = MagicMock()
+        search.json.return_value = {"tracks": {"items": [
+            {"id": "seed", "name": "Song Name", "uri": "spotify:track:seed"}]}}
+        recommendations = MagicMock()
+        recommendations.json.return_value = {"tracks": [
+            {"name": f"song{i}", "uri": f"spotify:track:{i}"} for i in range(30)]}
+        mock_get.side_effect = [search, recommendations]
+        track_search_index.clear()
+        similar_tracks_cache.clear()
+        track_index.clear()
+
+        first = get_similar("Song Name", 5)
+        second = get_similar("  song name ", 5)
+        self.assertEqual(len(first), 5)
+        self.assertEqual(list(second.keys()), [1, 2, 3, 4, 5])
+        self.assertEqual(mock_get.call_count, 2)
+        self.assertEqual(
+            get_similar_cache_stats()["similar_tracks"]["hits"], 1)
+
+    @patch('songs.get_spotify_token', MagicMock(return_value="token"))
+    @patch('http_client.get')
+    def test_get_similar_shares_the_fetch_but_samples_per_caller(self, mock_get):
+        started = threading.Event()
+        release = threading.Event()
+        search = MagicMock()
+        search.json.return_value = {"tracks": {"items": [
+            {"id": "shared", "name": "Shared Song", "uri": "spotify:track:shared"}]}}
+        recommendations = MagicMock()
+        recommendations.json.return_value = {"tracks": [
+            {"name": f"song{i}", "uri": f"spotify:track:{i}"} for i in range(30)]}
+
+        def get(url, **kwargs):
+            if url.endswith('/search'):
+                started.set()
+                release.wait(5)
+                return search
+            return recommendations
+        mock_get.side_effect = get
+        track_search_index.clear()
+        similar_tracks_cache.clear()
+        track_index.clear()
+
+        group = get_similar_pool.single_flight
+        shared_before = group.get_stats()['shared']
+        results = []
+        with patch('songs.sample_similar', wraps=sample_similar) as mock_sample:
+            threads = [threading.Thread(target=lambda: results.append(get_similar("Shared Song", 5)))
+                       for _ in range(2)]
+            threads[0].start()
+            started.wait(5)
+            threads[1].start()
+            deadline = time.monotonic() + 5
+            while group.get_stats()['shared'] == shared_before and time.monotonic() < deadline:
+                time.sleep(0.01)
+            release.set()
+            for thread in threads:
+                thread.join(5)
+
+        self.assertEqual(mock_get.call_count, 2)
+        self.assertEqual(mock_sample.call_count, 2)
+        self.assertEqual([len(songs) for songs in results], [5, 5])
+
+    def test_track_index_finds_tracks_seen_together(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            index = TrackIndex(capacity=50,
+                               db_path=os.path.join(tmp, 'index.db'))
+            seed = Track("seed", "artist", "album", "link",
+                         None, 10, "spotify:track:seed")
+            together = [Track(f"song{i}", f"artist{i}", "album", "link", None, i, f"spotify:track:{i}")
+                        for i in range(12)]
+            index.add_tracks([seed] + together, context="playlist:p1")
+            # A single playlist in common isn't enough to skip asking Spotify
+            self.assertIsNone(index.similar("spotify:track:seed", 5, min_neighbours=1))
+            index.add_tracks([seed] + together, context="playlist:p2")
+            self.assertIsNone(index.similar("spotify:track:cold", 5))
+
+            similar = index.similar("spotify:track:seed", 5)
+            self.assertEqual(len(similar), 5)
+            self.assertNotIn(seed, similar)
+            # Ties go to the more popular track
+            self.assertEqual(similar[0].uri, "spotify:track:11")
+
+            # The catalog is persisted, a new index picks it up
+            self.assertEqual(len(TrackIndex(capacity=50,
+                                            db_path=os.path.join(tmp, 'index.db'))), 13)
+            db.close_db_connection(os.path.join(tmp, 'index.db'))
+
+    def test_track_index_keeps_unrelated_contexts_apart(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            index = TrackIndex(capacity=2000,
+                               db_path=os.path.join(tmp, 'index.db'))
+            # Far more playlists than the old hashed layout had buckets, none of them share a track or artist
+            for i in range(600):
+                pair = [Track(f"song{i}{side}", f"artist{i}{side}", "album", "link", None, 50,
+                              f"spotify:track:{i}{side}") for side in "ab"]
+                index.add_tracks(pair, context=f"playlist:{i}")
+                index.add_tracks(pair, context=f"saved:{i}")
+
+            similar = index.similar("spotify:track:0a", 10, min_neighbours=1)
+            self.assertEqual([track.uri for track in similar], ["spotify:track:0b"])
+            self.assertIsNone(index.similar("spotify:track:0a", 10))
+            db.close_db_connection(os.path.join(tmp, 'index.db'))
+
+    def test_track_from_spotify(self):
+        item = {"name": "song1", "artists": [{"name": "artist1"}], "album": {"name": "album1", "images": []},
+                "popularity": 50, "uri": "spotify:track:1"}
+        track = Track.from_spotify(item)
+        self.assertEqual(track.song_name, "song1")
+        self.assertEqual(track["artist_name"], "artist1")
+        self.assertIsNone(track.album_cover)
+        self.assertEqual(track.song_link, "URL not available")
+        self.assertIs(track.artist_name, Track.from_spotify(
+            dict(item, name="song2")).artist_name)
+        with self.assertRaises(AttributeError):
+            track.song_name = "changed"
+
+    def test_db_connection_is_reused_per_thread(self):
+        conn = db.get_db_connection()
+        self.assertIs(conn, db.get_db_connection())
+        self.assertEqual(conn.execute(
+            "PRAGMA journal_mode").fetchone()[0], "wal")
+
+        other = []
+        thread = threading.Thread(
+            target=lambda: other.append(db.get_db_connection()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(conn, other[0])
+
+    def test_register_and_login_user(self):
+        user_id, error = register_user("db_test_user", "secret")
+        self.assertIsNone(error)
+        self.assertEqual(login_user("db_test_user", "secret")
+                         ["user_id"], user_id)
+        self.assertEqual(register_user("db_test_user", "secret")[
+                         0], None)
+        self.assertEqual(get_user_by_id(user_id)["username"], "db_test_user")
+
+    def test_migrations_dedupe_saved_songs_and_save_is_idempotent(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "migrate.db")
+            self.assertEqual(migrate(path, target_version=1), 1)
+            conn = db.get_db_connection(path)
+            for _ in range(2):
+                conn.execute("INSERT INTO saved_songs (song_name, artist_name, song_link, uri, user_id) VALUES ('s', 'a', 'l', 'u1', 7)")
+            conn.commit()
+
+            self.assertEqual(migrate(path), LATEST_VERSION)
+            self.assertEqual(conn.execute(
+                "SELECT COUNT(*) FROM saved_songs").fetchone()[0], 1)
+            db.close_db_connection(path)
+
+        first = save_song(99, "song", "artist", "album", "link", "spotify:track:x")
+        self.assertEqual(save_song(99, "song", "artist", "album",
+                         "link", "spotify:track:x"), first)
+        self.assertEqual(len(get_saved_songs(99)), 1)
+
+    def test_saved_songs_keyset_pagination(self):
+        ids = [save_song(55, f"song {i}", "artist", "album", "link", f"spotify:track:page{i}")
+               for i in range(5)]
+
+        first_page = get_saved_songs_page(55, limit=2)
+        self.assertEqual([song['id'] for song in first_page], ids[:-3:-1])
+        second_page = get_saved_songs_page(55, first_page[-1]['id'], 2)
+        self.assertEqual([song['id'] for song in second_page], [ids[2], ids[1]])
+
+        self.assertEqual([song['id'] for song in iter_saved_songs(55, page_size=2)],
+                         ids[::-1])
+
+    @patch('http_client.post')
+    def test_add_tracks_to_playlist_dedupes_and_chunks(self, mock_post):
+        mock_post.return_value.status_code = 201
+        mock_post.return_value.json.return_value = {"snapshot_id": "snap"}
+        uris = [f"spotify:track:{i}" for i in range(250)] + ["spotify:track:0"]
+
+        with self.request_context(access_token="token", expires_at=time.time() + 3600):
+            results = add_tracks_to_playlist("playlist", uris)
+
+        self.assertEqual([result['count'] for result in results], [100, 100, 50])
+        self.assertTrue(all(result['success'] for result in results))
+        sent = [uri for call in mock_post.call_args_list for uri in call.kwargs['json']['uris']]
+        self.assertEqual(sorted(sent), sorted(set(uris)))
+
+    def test_save_songs_bulk_is_idempotent(self):
+        songs = [{"song_name": f"song {i}", "artist_name": "artist", "album_name": "album",
+                  "song_link": "link", "uri": f"spotify:track:bulk{i}"} for i in range(3)]
+
+        self.assertEqual(save_songs_bulk(77, songs), 3)
+        self.assertEqual(save_songs_bulk(77, songs + [dict(songs[0], uri="spotify:track:bulk3")]), 1)
+        self.assertEqual(len(get_saved_songs(77)), 4)
+
+    @patch('playlist_feature.get_user_info', MagicMock(return_value={"id": "spotify_user"}))
+    @patch('http_client.post')
+    @patch('http_client.get')
+    def test_get_user_playlists_pages_and_caches(self, mock_get, mock_post):
+        def get_page(url, headers=None, params=None):
+            response = MagicMock(status_code=200)
+            offset = params['offset']
+            response.json.return_value = {"total": 120, "items": [
+                {"id": f"p{i}"} for i in range(offset, min(offset + 50, 120))]}
+            return response
+        mock_get.side_effect = get_page
+        mock_post.return_value.status_code = 201
+        mock_post.return_value.json.return_value = {"id": "new", "snapshot_id": "snap"}
+
+        with self.request_context(user_id=1, access_token="token", expires_at=time.time() + 3600):
+            user_playlists_cache.clear()
+
+            playlists = get_user_playlists()
+            self.assertEqual([p['id'] for p in playlists], [f"p{i}" for i in range(120)])
+            self.assertIs(get_user_playlists(), playlists)
+            self.assertEqual(mock_get.call_count, 3)
+
+            create_playlist_helper("new", "", False)
+            get_user_playlists()
+            self.assertEqual(mock_get.call_count, 6)
+
+            add_tracks_to_playlist("new", ["spotify:track:1"])
+            get_user_playlists()
+            self.assertEqual(mock_get.call_count, 9)
+
+    @patch('playlist_feature.get_user_info')
+    def test_spotify_user_id_is_fetched_once(self, mock_get_user_info):
+        mock_get_user_info.return_value = {"id": "spotify_user"}
+
+        with self.request_context(user_id=2):
+            spotify_profile_cache.clear()
+            self.assertEqual(get_spotify_user_id(), "spotify_user")
+            self.assertEqual(get_spotify_user_id(), "spotify_user")
+            session.pop('spotify_user_id')
+            self.assertEqual(get_spotify_user_id(), "spotify_user")
+
+        self.assertEqual(mock_get_user_info.call_count, 1)
+
+    @patch('playlist_feature.load_spotify_profile')
+    @patch('http_client.post')
+    def test_ensure_fresh_token_refreshes_once_near_expiry(self, mock_post, mock_load_spotify_profile):
+        mock_post.return_value.json.return_value = {
+            "access_token": "new_token", "expires_in": 3600}
+
+        recently_refreshed_tokens.clear()
+        for _ in range(2):
+            with self.request_context(user_id=3, access_token="old_token", refresh_token="refresh",
+                                      expires_at=time.time() + 30):
+                self.assertTrue(ensure_fresh_token())
+                self.assertEqual(session['access_token'], "new_token")
+                self.assertGreater(session['expires_at'], time.time() + 3000)
+
+        # Another session of the same user may be linked to another Spotify account, it never gets these tokens
+        mock_post.return_value.json.return_value = {
+            "access_token": "other_token", "expires_in": 3600}
+        with self.request_context(user_id=3, access_token="old_other", refresh_token="other_refresh",
+                                  expires_at=time.time() + 30):
+            self.assertTrue(ensure_fresh_token())
+            self.assertEqual(session['access_token'], "other_token")
+
+        with self.request_context(access_token="expired", expires_at=time.time() - 1):
+            self.assertFalse(ensure_fresh_token())
+
+        self.assertEqual(mock_post.call_count, 2)
+        self.assertEqual(mock_load_spotify_profile.call_count, 2)
+
+    def test_server_side_session_round_trip(self):
+        backend = MemorySessionBackend()
+        test_app = Flask(__name__)
+        test_app.session_interface = ServerSideSessionInterface(backend)
+
+        @test_app.route('/set')
+        def set_value():
+            session['genre'] = 'pop'
+            session['weather_stats'] = (75, 'Sunny')
+            return ''
+
+        @test_app.route('/get')
+        def get_value():
+            return {'genre': session.get('genre'), 'is_tuple': isinstance(session['weather_stats'], tuple)}
+
+        @test_app.route('/untouched')
+        def untouched():
+            return ''
+
+        @test_app.route('/clear')
+        def clear():
+            session.clear()
+            return ''
+
+        client = test_app.test_client()
+        client.get('/set')
+        sid = client.get_cookie('session').value
+        self.assertLess(len(sid), 64)
+        self.assertEqual(client.get('/get').get_json(), {'genre': 'pop', 'is_tuple': True})
+
+        with patch.object(backend, 'get', wraps=backend.get) as mock_backend_get:
+            client.get('/untouched')
+            mock_backend_get.assert_not_called()
+
+        client.get('/clear')
+        self.assertIsNone(backend.get(sid))
+
+    def test_server_side_session_ignores_planted_ids_and_regenerates(self):
+        backend = MemorySessionBackend()
+        test_app = Flask(__name__)
+        test_app.session_interface = ServerSideSessionInterface(backend)
+
+        @test_app.route('/set')
+        def set_value():
+            session['genre'] = 'pop'
+            return ''
+
+        @test_app.route('/login')
+        def login():
+            session.regenerate()
+            session['user_id'] = 1
+            return ''
+
+        client = test_app.test_client()
+        client.set_cookie('session', 'planted')
+        client.get('/set')
+        sid = client.get_cookie('session').value
+        self.assertNotEqual(sid, 'planted')
+        self.assertIsNone(backend.get('planted'))
+
+        client.get('/login')
+        new_sid = client.get_cookie('session').value
+        self.assertNotEqual(new_sid, sid)
+        self.assertIsNone(backend.get(sid))
+        self.assertEqual(backend.get(new_sid), {'genre': 'pop', 'user_id': 1})
+
+    def test_sqlite_session_backend_sweeps_expired(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "sessions.db")
+            backend = SQLiteSessionBackend(path)
+            backend.set("live", {"a": 1}, time.time() + 60)
+            backend.set("dead", {"a": 2}, time.time() - 1)
+
+            self.assertEqual(backend.get("live"), {"a": 1})
+            self.assertIsNone(backend.get("dead"))
+            self.assertEqual(backend.sweep(), 1)
+            db.close_db_connection(path)
+
+    def test_result_cache_round_trip_is_per_user(self):
+        songs = {1: Track("song", "artist", "album", "link", None, 50, "spotify:track:1")}
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = PersistentCache("recommendation_results",
+                                    db_path=os.path.join(tmp, "cache.db"))
+            with patch('result_cache.result_cache', cache):
+                result_id = store_result(1, songs, {"mood": "happy"})
+                self.assertEqual(load_result(1, result_id), (songs, {"mood": "happy"}))
+                self.assertEqual(load_result(2, result_id), (None, None))
+                self.assertEqual(load_result(1, "missing"), (None, None))
+            db.close_db_connection(cache.db_path)
+
     def test_hash_password(self):
         password = "password123"
         hashed_password = hash_password(password)
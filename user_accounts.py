@@ -1,4 +1,5 @@
 import sqlite3
+from db import get_db_connection
 import hashlib
 from dotenv import load_dotenv
 import os
@@ -7,30 +8,6 @@ import os
 load_dotenv()
 
 
-def get_db_connection():
-    """
-    Function to connect to SQLite database
-    """
-    conn = sqlite3.connect('users.db')
-    conn.row_factory = sqlite3.Row  # Allows fetching rows as dictionaries
-    return conn
-
-
-def create_users_table():
-    """
-    Create users table if not exists
-    """
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS users (
-                   user_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                   username TEXT UNIQUE NOT NULL,
-                   password TEXT NOT NULL
-               )''')
-    conn.commit()
-    conn.close()
-
-
 def hash_password(password):
     """
     Safely hash password.
@@ -55,10 +32,9 @@ def register_user(username, password):
                   (username, hashed_password))
         conn.commit()
         user_id = c.lastrowid
-        conn.close()
         return user_id, None  # Return user ID and no error message if successful
     except sqlite3.IntegrityError:
-        conn.close()
+        conn.rollback()
         return None, "Username already exists. Please choose a different username."
 
 
@@ -72,7 +48,6 @@ def login_user(username_or_id, password):
     c.execute("SELECT * FROM users WHERE (username=? OR user_id=?) AND password=?",
               (username_or_id, username_or_id, hashed_password))
     user = c.fetchone()
-    conn.close()
     return user
 
 
@@ -84,9 +59,4 @@ def get_user_by_id(user_id):
     c = conn.cursor()
     c.execute("SELECT * FROM users WHERE user_id=?", (user_id,))
     user = c.fetchone()
-    conn.close()
     return user
-
-
-# Call this function once to create a table if it doesn't exist
-create_users_table()